@@ -0,0 +1,159 @@
+import threading
+import time
+from collections import deque
+
+# (tokens per second, burst) per source host and message type
+DEFAULT_BUDGETS = {
+    # forwarded GOSSIP of the whole network reaches us through a handful of neighbours
+    "GOSSIP": (5, 20),
+    "GOSSIP_REPLY": (0.5, 5),
+    "STATS": (1, 10),
+    "STATS_REPLY": (1, 10),
+    # sized to a syncing BlockDownloadScheduler, which keeps a window in flight and refills it as replies land:
+    # 16 GET_BLOCK per 10 ms round trip from a plain peer, or 4 GET_BLOCKS runs of 64 per 5 ms from a range peer;
+    # the bursts let a sub-millisecond link (loopback, LAN) run ahead of that rate for a few hundred blocks
+    "GET_BLOCK": (1600, 400),
+    "GET_BLOCKS": (800, 32),
+    "ANNOUNCE": (1, 5),
+    "CONSENSUS": (1 / 60, 1),
+    # block replies we did not ask for, the ones we asked for are not rate limited
+    "UNSOLICITED": (20, 50),
+}
+# anything not listed above
+OTHER_BUDGET = (5, 10)
+# shared by every source, a crowd of hosts can't force back to back consensus runs either
+GLOBAL_BUDGETS = {
+    "CONSENSUS": (0.1, 1),
+}
+
+# queue priorities, lower is handled first
+SOLICITED = 0
+CONTROL = 1
+REQUEST = 2
+BULK = 3
+PRIORITIES = {
+    "STATS_REPLY": CONTROL,
+    "GOSSIP_REPLY": CONTROL,
+    "ANNOUNCE": CONTROL,
+    "GOSSIP": REQUEST,
+    "STATS": REQUEST,
+    "GET_BLOCK": REQUEST,
+    "GET_BLOCKS": REQUEST,
+}
+
+
+class AdmissionControl:
+    """
+    Sits between the receive side and the handlers.
+        - every (host, type) has a token bucket, a message over budget is dropped before it is queued; keyed
+          on the host alone, a flooder doesn't get a fresh burst by changing its source port
+        - admitted messages wait in a bounded queue with one FIFO per priority, the handler side always
+          takes from the most important one first
+        - when the queue is full a message sheds the newest one of a less important priority,
+          or is shed itself if there is none
+    So under a flood the block replies we asked for still go straight through, and the flood only
+    competes with itself. Thread safe, one lock around buckets and queue.
+    """
+
+    def __init__(self, budgets=None, max_queue=4096, max_sources=20000):
+        self.budgets = dict(DEFAULT_BUDGETS, **(budgets or {}))
+        self.max_queue = max_queue
+        self.max_sources = max_sources
+        # (host, type) -> [tokens, last refill], (None, type) for the global ones
+        self.buckets = {}
+        self.levels = [deque() for _ in range(BULK + 1)]
+        self.size = 0
+        self.cond = threading.Condition()
+        # counters
+        self.admitted = 0
+        self.dropped = {}
+        self.shed = {}
+
+    def allow(self, host, budget_type, now):
+        """Take a token from the source host's bucket for `budget_type`, and from the global one if it has one"""
+        rate, burst = self.budgets.get(budget_type, OTHER_BUDGET)
+        if not self.take_token((host, budget_type), rate, burst, now):
+            return False
+        if budget_type in GLOBAL_BUDGETS:
+            rate, burst = GLOBAL_BUDGETS[budget_type]
+            if not self.take_token((None, budget_type), rate, burst, now):
+                return False
+        return True
+
+    def take_token(self, key, rate, burst, now):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            # bounded, forgetting buckets only hands their sources a fresh burst
+            if len(self.buckets) >= self.max_sources:
+                self.buckets.clear()
+            bucket = self.buckets[key] = [burst, now]
+        else:
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+    def offer(self, event, host, port, msg_type, solicited=False, now=None):
+        """
+        Queue `event` (anything, handed back by `take`) for a message of `msg_type` from host:port.
+        `solicited` block replies skip the buckets and go first. False if it was dropped or shed.
+        """
+        now = time.monotonic() if now is None else now
+        if solicited:
+            priority = SOLICITED
+        elif msg_type in PRIORITIES:
+            priority = PRIORITIES[msg_type]
+        else:
+            priority = BULK
+        with self.cond:
+            if not solicited:
+                budget_type = "UNSOLICITED" if msg_type in ("GET_BLOCK_REPLY", "GET_BLOCKS_REPLY") else msg_type
+                if not self.allow(host, budget_type, now):
+                    self.dropped[msg_type] = self.dropped.get(msg_type, 0) + 1
+                    return False
+            if self.size >= self.max_queue:
+                for level in range(BULK, priority, -1):
+                    if self.levels[level]:
+                        shed_type, _ = self.levels[level].pop()
+                        self.shed[shed_type] = self.shed.get(shed_type, 0) + 1
+                        self.size -= 1
+                        break
+                else:
+                    self.shed[msg_type] = self.shed.get(msg_type, 0) + 1
+                    return False
+            self.levels[priority].append((msg_type, event))
+            self.size += 1
+            self.admitted += 1
+            self.cond.notify()
+        return True
+
+    def take(self, max_items=64, timeout=None):
+        """Up to `max_items` queued events, most important first, waits up to `timeout` for the first one"""
+        with self.cond:
+            if not self.size and not self.cond.wait_for(lambda: self.size, timeout):
+                return []
+            return self.pop(max_items)
+
+    def poll(self, max_items=64):
+        """`take` without waiting"""
+        with self.cond:
+            return self.pop(max_items)
+
+    def pop(self, max_items):
+        events = []
+        for level in self.levels:
+            while level and len(events) < max_items:
+                events.append(level.popleft()[1])
+        self.size -= len(events)
+        return events
+
+    def counters(self):
+        with self.cond:
+            return {
+                "admitted": self.admitted,
+                "queued": self.size,
+                "dropped": dict(self.dropped),
+                "shed": dict(self.shed)
+            }
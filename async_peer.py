@@ -0,0 +1,177 @@
+import asyncio
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+from peer import Peer, check_chain, decode_datagram, log, type_label
+from peer_log import fields
+
+# a run of arrived blocks up to this long is hashed inline on the loop, a longer one (a gap just filled) in the executor
+INLINE_VERIFY_RUN = 8
+# a deferred run goes to the executor in slices this long, building, shipping and applying one stays short on the loop
+DEFERRED_VERIFY_RUN = 1024
+
+
+class AsyncPeer(Peer, asyncio.DatagramProtocol):
+    """
+    Peer driven by a single asyncio loop instead of a `listen` thread plus an EventQueue thread.
+    Every handler and periodic job runs on the loop, so peer state is only ever touched by one thread.
+    Only the hashing in chain verification and mining leaves the loop, to process pools.
+    """
+
+    def __init__(self, port, name, gossip_id, verify_workers=1, bootstrap_peers=None, host=None):
+        super().__init__(port, name, gossip_id, bootstrap_peers=bootstrap_peers, host=host)
+        self.transport = None
+        self.verify_workers = verify_workers
+        self.executor = None
+        # a `drain_admitted` call is already on the loop's ready queue
+        self.drain_scheduled = False
+        # a `verify_deferred` task is running, it picks up whatever arrives meanwhile
+        self.verify_scheduled = False
+
+    # asyncio.DatagramProtocol ---------------------------------------------------------------------------------------
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            msg = decode_datagram(data)  # Decode JSON
+            self.receive(addr, msg)  # Queue it, handled once this round of datagrams is in
+        except json.JSONDecodeError as e:
+            # print(f"Invalid JSON received from {addr}: {data}. Error: {e}")
+            self.metrics.inc("malformed_total")
+        except Exception as e:
+            # print(f"Error while handling data: {e}")
+            self.metrics.inc("malformed_total")
+        if not self.drain_scheduled and self.admission.size:
+            self.drain_scheduled = True
+            asyncio.get_running_loop().call_soon(self.drain_admitted)
+
+    def drain_admitted(self):
+        """
+        Run admitted msgs in priority order. Scheduled behind the datagrams the loop already read,
+        so a burst gets ranked as a whole; more than one batch is spread over loop iterations.
+        """
+        for host, port, msg_type, message in self.admission.poll():
+            try:
+                self.dispatch(host, port, msg_type, message)
+            except Exception as e:
+                # print(f"Error while handling data: {e}")
+                self.metrics.inc("handler_errors_total", type_label(msg_type))
+        if self.admission.size:
+            asyncio.get_running_loop().call_soon(self.drain_admitted)
+        else:
+            self.drain_scheduled = False
+
+    def error_received(self, exc):
+        # ICMP errors from peers that went away, same as the threaded listener we ignore them
+        self.metrics.inc("socket_errors_total", "recv")
+
+    def send_to(self, data, host, port):
+        if self.transport is not None:
+            self.transport.sendto(data, (host, port))
+        else:
+            super().send_to(data, host, port)
+
+    # RUNTIME --------------------------------------------------------------------------------------------------------
+    async def periodic(self, delay, interval, callback, args=None):
+        """asyncio equivalent of `EventQueue.add_event`, anchored to the loop clock so it doesn't drift"""
+        loop = asyncio.get_running_loop()
+        next_run = loop.time() + delay
+        while True:
+            await asyncio.sleep(max(0.0, next_run - loop.time()))
+            try:
+                result = callback(*(args or []))
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception as e:
+                log.error("job failed", extra=fields(job=getattr(callback, '__name__', callback), error=e))
+            next_run += interval
+            # fell a whole interval behind, skip the missed runs
+            if next_run <= loop.time():
+                next_run = loop.time() + interval
+
+    def verify_from_tip(self):
+        """
+        `Peer.verify_from_tip` for the handlers: a short run is hashed inline, a longer one is handed to
+        `verify_deferred` so a filled gap of thousands of blocks never stalls the loop.
+        """
+        if self.executor is None:
+            super().verify_from_tip()
+            return
+        if self.verify_scheduled:
+            return
+        tip = self.verified_tip
+        if all(height in self.block_tracker for height in range(tip, tip + INLINE_VERIFY_RUN + 1)):
+            self.verify_scheduled = True
+            asyncio.get_running_loop().create_task(self.verify_deferred())
+        else:
+            super().verify_from_tip()
+
+    async def verify_deferred(self):
+        tip = self.verified_tip
+        try:
+            await self.verify_pending_async(DEFERRED_VERIFY_RUN)
+        except Exception as e:
+            log.error("job failed", extra=fields(job="verify_deferred", error=e))
+        finally:
+            self.verify_scheduled = False
+        # blocks that came in while the run was hashed, inline or deferred again; a run that didn't move the tip
+        # (failed, dropped as stale, nothing to verify) is left to the verify tick instead of spinning here
+        if self.verified_tip != tip:
+            self.verify_from_tip()
+
+    async def verify_block_chain_async(self):
+        """`verify_block_chain` with the hashing of a long backlog pushed to the executor, a slice at a time"""
+        if not self.verify_scheduled:
+            self.verify_scheduled = True
+            await self.verify_deferred()
+        self.persist_verified()
+        self.log_verify_summary()
+
+    async def verify_pending_async(self, limit=None):
+        """Check the run after the tip (up to `limit` blocks) in the executor, the outcome is applied back on the loop"""
+        pending = self.pending_verification(limit)
+        if pending is not None:
+            prev_hash, run = pending
+            loop = asyncio.get_running_loop()
+            if self.verifier is not None:
+                # the verifier has its own process pool, a thread just waits on it
+                verified, bad_height = await loop.run_in_executor(None, self.check_run, prev_hash, run)
+            else:
+                verified, bad_height = await loop.run_in_executor(self.executor, check_chain, prev_hash, run,
+                                                                  self.difficulty, self.block_tracker.known_good(run),
+                                                                  None, self.checkpoints.covering(run))
+            # dropped by apply_verification if add_block moved the tip meanwhile
+            self.apply_verification(pending, verified, bad_height)
+
+    async def mine_forever_async(self):
+        """`mine_forever` with the search in a thread, the block is added and announced back on the loop"""
+        loop = asyncio.get_running_loop()
+        while True:
+            block = await loop.run_in_executor(None, self.mine_next)
+            if block is None:
+                await asyncio.sleep(1)
+            else:
+                self.add_mined_block(block)
+
+    async def serve(self, jobs):
+        """
+        Attach to the already bound socket and run `jobs`, a list of (delay, interval, callback, args)
+        as tasks on the same loop. `verify_block_chain` is swapped for the executor backed version.
+        """
+        loop = asyncio.get_running_loop()
+        self.executor = ProcessPoolExecutor(max_workers=self.verify_workers)
+        await loop.create_datagram_endpoint(lambda: self, sock=self.socket)
+        log.info("listening", extra=fields(port=self.port, mode="async"))
+        tasks = []
+        for delay, interval, callback, args in jobs:
+            if callback == self.verify_block_chain:
+                callback = self.verify_block_chain_async
+            tasks.append(asyncio.create_task(self.periodic(delay, interval, callback, args)))
+        if self.miner is not None:
+            tasks.append(asyncio.create_task(self.mine_forever_async()))
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            self.transport.close()
+            self.executor.shutdown(wait=False)
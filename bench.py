@@ -0,0 +1,268 @@
+"""
+Microbenchmarks of the hot paths, every number is microseconds per operation (lower is better).
+    python3 bench.py                            run, write bench_results.json, compare with bench_baseline.json
+    python3 bench.py --save-baseline            run and store the results as the new baseline
+    python3 bench.py --full                     also verify a 100k block chain
+    python3 bench.py --only verification sql    run a subset
+Exits with 1 when a number got slower than the baseline by more than --tolerance.
+Baselines are machine specific, save one on the machine you compare on.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+import wire_codec
+from block_store import Block
+from checkpoints import Checkpoints
+from blockchain_sql import SQLDatabase
+from codec_bench import sample_messages
+from event_queue import EventQueue
+from peer import Peer, verification
+from simulator import synthetic_chain
+
+# chains are mined at this difficulty, verifying a block costs one hash whatever the difficulty
+DIFFICULTY = 1
+CHAINS = {}
+
+
+def chain_of(length):
+    """Synthetic chain, cached and extended across benchmarks"""
+    chain = CHAINS.get("chain", [])
+    if len(chain) < length:
+        chain = CHAINS["chain"] = synthetic_chain(length, DIFFICULTY)
+    return chain[:length]
+
+
+def best_of(repeat, func):
+    """Fastest of `repeat` runs of `func()` in seconds, `func` may return its own timing instead"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        measured = func()
+        times.append(measured if measured is not None else time.perf_counter() - start)
+    return min(times)
+
+
+def quiet_peer(**attributes):
+    """Peer on an ephemeral loopback port that sends nothing, at the benchmark difficulty"""
+    peer = Peer(0, "bench", "bench", host="127.0.0.1")
+    peer.difficulty = DIFFICULTY
+    peer.send_to = lambda data, host, port: None
+    for name, value in attributes.items():
+        setattr(peer, name, value)
+    return peer
+
+
+def bench_verification(args):
+    chain = chain_of(2000)
+    prevs = [""] + [block["hash"] for block in chain[:-1]]
+    pairs = list(zip(prevs, chain))
+
+    def run():
+        for prev_hash, block in pairs:
+            verification(prev_hash, block, DIFFICULTY)
+    return {"verification_us": best_of(args.repeat, run) / len(pairs) * 1e6}
+
+
+def bench_event_queue(args):
+    count = 5000
+    noop = lambda: None
+    results = {}
+    for label, offsets in (("in_order", [i * 1e-6 for i in range(count)]),
+                           ("random", [random.random() for _ in range(count)])):
+        add_times = []
+
+        def run():
+            queue = EventQueue()
+            base = time.time() - 10
+            start = time.perf_counter()
+            for offset in offsets:
+                queue.add_event(base + offset, noop)
+            add_times.append(time.perf_counter() - start)
+            queue.add_event(base + 2, queue.stop)
+            start = time.perf_counter()
+            queue.run()
+            return time.perf_counter() - start
+        results[f"run_{label}_us"] = best_of(args.repeat, run) / count * 1e6
+        results[f"add_event_{label}_us"] = min(add_times) / count * 1e6
+    return results
+
+
+def bench_add_block_duplicates(args):
+    chain = chain_of(2000)
+    copies = 5
+    # every block arrives `copies` times, shuffled, the way a few peers answering the same heights look
+    arrivals = [block for block in chain for _ in range(copies)]
+    random.Random(1).shuffle(arrivals)
+
+    def run():
+        peer = quiet_peer(consensus_key=(len(chain), chain[-1]["hash"]))
+        start = time.perf_counter()
+        for block in arrivals:
+            peer.add_block(block)
+        elapsed = time.perf_counter() - start
+        assert peer.verified_tip == len(chain)
+        peer.socket.close()
+        return elapsed
+    return {"add_block_us": best_of(args.repeat, run) / len(arrivals) * 1e6}
+
+
+def bench_verify_chain(args):
+    results = {}
+    for length in [1000, 10000] + ([100000] if args.full else []):
+        chain = chain_of(length)
+
+        def run(checkpoints=None):
+            peer = quiet_peer(consensus_key=(length, chain[-1]["hash"]))
+            if checkpoints is not None:
+                peer.checkpoints = checkpoints
+            for block in chain:
+                peer.block_tracker.add(Block.from_message(block))
+            start = time.perf_counter()
+            peer.verify_block_chain()
+            elapsed = time.perf_counter() - start
+            assert peer.verified_tip == length
+            peer.socket.close()
+            return elapsed
+        results[f"verify_chain_{length}_us_per_block"] = best_of(args.repeat, run) / length * 1e6
+        # exported anchors, every block is still hashed, this is what the anchor lookups add
+        checkpoints = Checkpoints.from_chain(chain, length)
+        results[f"verify_chain_{length}_checkpointed_us_per_block"] = \
+            best_of(args.repeat, lambda: run(checkpoints)) / length * 1e6
+    return results
+
+
+def bench_sql(args):
+    chain = chain_of(2000)
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        def per_block():
+            db = SQLDatabase(os.path.join(directory, f"{time.perf_counter_ns()}.db"))
+            start = time.perf_counter()
+            for block in chain:
+                db.add_block(block)
+            elapsed = time.perf_counter() - start
+            db.close()
+            return elapsed
+
+        def batched():
+            db = SQLDatabase(os.path.join(directory, f"{time.perf_counter_ns()}.db"))
+            start = time.perf_counter()
+            db.add_blocks(chain)
+            elapsed = time.perf_counter() - start
+            db.close()
+            return elapsed
+        results["add_block_us"] = best_of(args.repeat, per_block) / len(chain) * 1e6
+        results["add_blocks_batch_us"] = best_of(args.repeat, batched) / len(chain) * 1e6
+    return results
+
+
+def bench_codec(args):
+    iterations = 5000
+    messages = sample_messages()
+    block = messages["GET_BLOCK_REPLY"]
+    messages.update({
+        "GOSSIP": {"type": "GOSSIP", "host": "192.168.0.10", "port": 8999, "id": "f3c1e1a2-0000-4000-8000-000000000000:1",
+                   "name": "bench", "codecs": ["bin2"], "features": ["GET_BLOCKS"]},
+        "GOSSIP_REPLY": {"type": "GOSSIP_REPLY", "host": "192.168.0.10", "port": 8999, "name": "bench",
+                         "codecs": ["bin2"], "features": ["GET_BLOCKS"]},
+        "CONSENSUS": {"type": "CONSENSUS"},
+        "GET_BLOCKS": {"type": "GET_BLOCKS", "height": 12345, "count": 64},
+        "GET_BLOCKS_REPLY": {"type": "GET_BLOCKS_REPLY", "blocks": [dict(block, height=block["height"] + i)
+                                                                     for i in range(8)]},
+    })
+    results = {}
+    for msg_type, msg in messages.items():
+        codecs = [("json", lambda m: json.dumps(m).encode('utf-8'), lambda d: json.loads(d.decode('utf-8')))]
+        if wire_codec.encode(msg) is not None:
+            codecs.append(("binary", wire_codec.encode, wire_codec.decode))
+        for codec, encode, decode in codecs:
+            data = encode(msg)
+
+            def run_encode():
+                for _ in range(iterations):
+                    encode(msg)
+
+            def run_decode():
+                for _ in range(iterations):
+                    decode(data)
+            results[f"{msg_type}_{codec}_encode_us"] = best_of(args.repeat, run_encode) / iterations * 1e6
+            results[f"{msg_type}_{codec}_decode_us"] = best_of(args.repeat, run_decode) / iterations * 1e6
+    return results
+
+
+BENCHMARKS = {
+    "verification": bench_verification,
+    "event_queue": bench_event_queue,
+    "add_block": bench_add_block_duplicates,
+    "verify_chain": bench_verify_chain,
+    "sql": bench_sql,
+    "codec": bench_codec,
+}
+
+
+def compare(results, baseline, tolerance):
+    """Print current vs baseline, returns the (benchmark, metric) pairs slower by more than `tolerance`"""
+    regressions = []
+    print(f"{'benchmark':<14}{'metric':<44}{'us':>12}{'baseline':>12}{'change':>9}")
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            before = baseline.get(name, {}).get(metric)
+            if before:
+                change = value / before - 1
+                flag = " REGRESSION" if change > tolerance else ""
+                if flag:
+                    regressions.append((name, metric))
+                print(f"{name:<14}{metric:<44}{value:>12.3f}{before:>12.3f}{change:>+9.1%}{flag}")
+            else:
+                print(f"{name:<14}{metric:<44}{value:>12.3f}{'-':>12}{'':>9}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hot path microbenchmarks with a regression baseline")
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS), help="benchmarks to run")
+    parser.add_argument("--full", action="store_true", help="include the 100k block chain")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement, the fastest counts")
+    parser.add_argument("--out", default="bench_results.json")
+    parser.add_argument("--baseline", default="bench_baseline.json")
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown, 0.25 = 25%%")
+    args = parser.parse_args()
+
+    results = {}
+    for name in args.only or BENCHMARKS:
+        # logging is off unless `setup_logging` was called, this keeps stray debug prints out of the results
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            results[name] = BENCHMARKS[name](args)
+    report = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "time": int(time.time()),
+        "results": results
+    }
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+    regressions = compare(results, baseline, args.tolerance)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"baseline saved to {args.baseline}")
+    if regressions:
+        print(f"{len(regressions)} regressions over {args.tolerance:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+import heapq
+import threading
+import time
+
+
+class BlockDownloadScheduler:
+    """
+    Decides which block heights to ask which peer for.
+        - every height is in flight with at most one peer at a time
+        - each peer has at most `window` heights in flight
+        - a height not answered within `timeout` seconds goes back in the queue and is
+          retried against a peer that has not had it yet
+        - a height leaves the queue for good once `complete` is called for it
+        - peers that serve GET_BLOCKS get a wider window, handed out in runs of consecutive
+          heights so each run goes out as one range request; such a peer is only refilled once a
+          whole run (`range_chunk`) of its window is free, so replies trickling in don't turn
+          every freed slot into a single-height request
+    Lower heights go out first since verification walks the chain upwards.
+    Thread safe, one lock around every call: in threaded mode the handler thread completes heights
+    while the event thread's tick schedules and expires them.
+    """
+
+    def __init__(self, window=16, timeout=2.0, range_window=256, range_chunk=64):
+        # reentrant, public methods call each other and the peer holds it across a reset + schedule
+        self.lock = threading.RLock()
+        self.window = window
+        self.timeout = timeout
+        self.range_window = range_window
+        self.range_chunk = range_chunk
+        # heights [0, target) are wanted
+        self.target = 0
+        # heap of heights waiting for a peer, `queued` mirrors it for membership checks
+        self.pending = []
+        self.queued = set()
+        # height -> (peer, deadline)
+        self.in_flight = {}
+        # peer -> set of heights in flight with it
+        self.peer_load = {}
+        # height -> peers that timed out / sent garbage for it
+        self.tried = {}
+        # height -> peer whose answer completed it, blamed if the block later fails verification
+        self.answered_by = {}
+        # heights below `floor` (verified, or not wanted) are done without an entry, `done` only holds the ones above
+        # it, so it stays as small as the unverified part of the chain
+        self.floor = 0
+        self.done = set()
+        # counters
+        self.requests_sent = 0
+        self.timeouts = 0
+        self.retries = 0
+
+    def reset(self, start=0):
+        """Forget everything, used when the chain we are syncing changes. Heights below `start` are not wanted"""
+        with self.lock:
+            self.target = start
+            self.floor = start
+            self.pending.clear()
+            self.queued.clear()
+            self.in_flight.clear()
+            self.peer_load.clear()
+            self.tried.clear()
+            self.answered_by.clear()
+            self.done.clear()
+
+    def set_target(self, target, have=()):
+        """Want heights [0, target), skipping those in `have`. Only the new tail is queued on growth"""
+        with self.lock:
+            if target < self.target:
+                self.reset()
+            for height in range(self.target, target):
+                if height in have:
+                    self.done.add(height)
+                else:
+                    self.enqueue(height)
+            self.target = target
+
+    def want(self, heights):
+        """Ask for `heights` again, e.g. they were dropped after a fork"""
+        with self.lock:
+            heights = [height for height in heights if height < self.target]
+            if heights:
+                self.lower_floor(min(heights))
+            for height in heights:
+                self.done.discard(height)
+                self.release(height)
+                self.enqueue(height)
+
+    def enqueue(self, height):
+        if height not in self.queued and height not in self.in_flight and not self.is_done(height):
+            heapq.heappush(self.pending, height)
+            self.queued.add(height)
+
+    def complete(self, height):
+        """A usable candidate for `height` arrived, never ask for it again. True if it answered a request in flight"""
+        with self.lock:
+            if self.is_done(height):
+                return False
+            self.done.add(height)
+            entry = self.in_flight.get(height)
+            if entry is not None:
+                self.answered_by[height] = entry[0]
+            self.release(height)
+            self.tried.pop(height, None)
+            # it stays in the heap until popped, `queued` is the source of truth
+            self.queued.discard(height)
+            return entry is not None
+
+    def forget(self, height):
+        """`height` is verified, nothing left to blame. Verified heights come in order, the floor moves past it"""
+        with self.lock:
+            self.answered_by.pop(height, None)
+            if height >= self.floor:
+                for done_height in range(self.floor, height + 1):
+                    self.done.discard(done_height)
+                self.floor = height + 1
+                if not self.done:
+                    # a set never shrinks its table on discard, a fresh one hands back what a long sync grew
+                    self.done = set()
+
+    def retry(self, height, bad_peer=None):
+        """
+        Ask for `height` again, avoiding `bad_peer`. Without one, the peer whose answer
+        completed the height is avoided (its block failed verification).
+        """
+        with self.lock:
+            self.lower_floor(height)
+            self.done.discard(height)
+            if bad_peer is None:
+                bad_peer = self.answered_by.pop(height, None)
+            if bad_peer is not None:
+                self.tried.setdefault(height, set()).add(bad_peer)
+            self.release(height)
+            if height < self.target:
+                self.retries += 1
+                self.enqueue(height)
+
+    def is_done(self, height):
+        return height < self.floor or height in self.done
+
+    def lower_floor(self, height):
+        # a height below the floor is wanted again (fork, bad block), the ones between stay done
+        if height < self.floor:
+            self.done.update(range(height, self.floor))
+            self.floor = height
+
+    def release(self, height):
+        entry = self.in_flight.pop(height, None)
+        if entry is not None:
+            self.peer_load.get(entry[0], set()).discard(height)
+
+    def expire(self, now):
+        """Requeue heights whose request timed out"""
+        with self.lock:
+            expired = [height for height, (peer, deadline) in self.in_flight.items() if deadline <= now]
+            for height in expired:
+                peer = self.in_flight[height][0]
+                self.timeouts += 1
+                self.retry(height, peer)
+
+    def schedule(self, peers, now=None, range_peers=()):
+        """
+        Fill every peer's free window slots from the queue.
+        peers: iterable of (host, port)
+        range_peers: the ones that serve GET_BLOCKS, they get `range_window` and runs of up to `range_chunk` heights
+        returns [(height, (host, port)), ...] to request, a range peer's consecutive heights are adjacent
+        """
+        with self.lock:
+            now = time.time() if now is None else now
+            self.expire(now)
+            peers = list(peers)
+            windows = {}
+            # free slots a peer needs before it gets more heights
+            room = {}
+            for peer in peers:
+                self.peer_load.setdefault(peer, set())
+                if peer in range_peers:
+                    windows[peer] = self.range_window
+                    room[peer] = min(self.range_chunk, self.range_window)
+                else:
+                    windows[peer] = self.window
+                    room[peer] = 1
+            assigned = []
+            skipped = []
+            while self.pending:
+                free = [peer for peer in peers if windows[peer] - len(self.peer_load[peer]) >= room[peer]]
+                if not free:
+                    break
+                height = heapq.heappop(self.pending)
+                if height not in self.queued:
+                    # completed while waiting
+                    continue
+                tried = self.tried.get(height, ())
+                fresh = [peer for peer in free if peer not in tried]
+                if not fresh:
+                    if all(peer in tried for peer in peers):
+                        # everyone had a go, start another round
+                        self.tried.pop(height, None)
+                        fresh = free
+                    else:
+                        # an untried peer exists but is busy, wait for it
+                        skipped.append(height)
+                        continue
+                # least loaded peer first
+                peer = min(fresh, key=lambda p: len(self.peer_load[p]) / windows[p])
+                self.assign(height, peer, now, assigned)
+                if peer in range_peers:
+                    # keep going with the heights right after it while the peer has room
+                    run_end = height + 1
+                    while (self.pending and self.pending[0] == run_end and run_end - height < self.range_chunk
+                           and len(self.peer_load[peer]) < windows[peer]):
+                        heapq.heappop(self.pending)
+                        if run_end in self.queued:
+                            tried = self.tried.get(run_end, ())
+                            if peer in tried and all(other in tried for other in peers):
+                                # everyone had a go at this one too, it stays in the run
+                                self.tried.pop(run_end, None)
+                                tried = ()
+                            if peer not in tried:
+                                self.assign(run_end, peer, now, assigned)
+                            else:
+                                skipped.append(run_end)
+                        run_end += 1
+            for height in skipped:
+                heapq.heappush(self.pending, height)
+            if not self.queued:
+                # same as `done` in `forget`, a whole chain was queued at once
+                self.queued = set()
+            self.requests_sent += len(assigned)
+            return assigned
+
+    def assign(self, height, peer, now, assigned):
+        self.queued.discard(height)
+        self.in_flight[height] = (peer, now + self.timeout)
+        self.peer_load[peer].add(height)
+        assigned.append((height, peer))
+
+    def awaiting(self, peer):
+        """True while `peer` has requests of ours in flight"""
+        with self.lock:
+            return bool(self.peer_load.get(peer))
+
+    def progress(self):
+        with self.lock:
+            return {
+                "target": self.target,
+                "done": self.floor + len(self.done),
+                "in_flight": len(self.in_flight),
+                "queued": len(self.queued),
+                "requests_sent": self.requests_sent,
+                "timeouts": self.timeouts,
+                "retries": self.retries
+            }
@@ -0,0 +1,145 @@
+# `BlockStore.add` results
+ADDED = "added"
+DROPPED = "dropped"
+REJECTED = "rejected"
+
+
+class Block:
+    """
+    Parsed candidate block. `__getitem__`/`get` keep it usable wherever a block json dict is expected
+    (`verification`, `check_chain`) without building one.
+    """
+    __slots__ = ("hash", "height", "messages", "minedBy", "nonce", "timestamp", "fingerprint")
+
+    def __init__(self, block_hash, height, messages, mined_by, nonce, timestamp):
+        self.hash = block_hash
+        self.height = height
+        self.messages = messages
+        self.minedBy = mined_by
+        self.nonce = nonce
+        self.timestamp = timestamp
+        # cheap identity of the content the hash is claimed over, tells apart blocks claiming the same hash
+        self.fingerprint = hash((mined_by, messages, timestamp, nonce))
+
+    @classmethod
+    def from_message(cls, message):
+        """From a `block_msg_valid` GET_BLOCK_REPLY/ANNOUNCE"""
+        return cls(message["hash"], message["height"], tuple(message["messages"]),
+                   message["minedBy"], message["nonce"], message["timestamp"])
+
+    def to_message(self):
+        """Back to the GET_BLOCK_REPLY format kept in verified_blocks"""
+        return {
+            "type": "GET_BLOCK_REPLY",
+            "hash": self.hash,
+            "height": self.height,
+            "messages": list(self.messages),
+            "minedBy": self.minedBy,
+            "nonce": self.nonce,
+            "timestamp": self.timestamp
+        }
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+
+class BlockStore:
+    """
+    Candidate blocks per height, replaces the per-height sets of json strings in `block_tracker`.
+        - candidates are deduplicated by claimed hash, a chatty peer resending a block costs a dict lookup
+        - at most `max_candidates` are kept per height
+        - candidates that failed verification are remembered and dropped on arrival,
+          until `forget_rejected` (our prefix changed, so they may link now)
+        - (hash, fingerprint) -> prev_hash of the last `max_verified` blocks that passed verification, so a block
+          sent again after the tip moved back (a fork or resync near the tip) is not hashed twice; older entries are
+          dropped oldest first, a rollback deeper than that re-hashes
+    """
+
+    def __init__(self, max_candidates=4, max_remembered=200000, max_verified=2048):
+        self.max_candidates = max_candidates
+        self.max_remembered = max_remembered
+        self.max_verified = max_verified
+        # height -> {hash: Block}
+        self.heights = {}
+        self.verified = {}
+        self.rejected = set()
+        self.duplicates = 0
+        self.capped = 0
+
+    def add(self, block):
+        """
+        Keep `block` as a candidate: ADDED, DROPPED for a duplicate or over the cap, REJECTED if it already failed
+        verification (the caller still owes its sender the blame, it is just not hashed again)
+        """
+        if (block.hash, block.fingerprint) in self.rejected:
+            return REJECTED
+        candidates = self.heights.get(block.height)
+        if candidates is None:
+            candidates = self.heights[block.height] = {}
+        elif block.hash in candidates:
+            self.duplicates += 1
+            return DROPPED
+        elif len(candidates) >= self.max_candidates:
+            self.capped += 1
+            return DROPPED
+        candidates[block.hash] = block
+        return ADDED
+
+    def candidates(self, height):
+        return list(self.heights.get(height, {}).values())
+
+    def reject(self, height):
+        """Every candidate at `height` failed verification, drop them and ignore them if sent again"""
+        for block in self.heights.pop(height, {}).values():
+            self.remember(self.rejected, (block.hash, block.fingerprint))
+
+    def forget_rejected(self):
+        self.rejected.clear()
+
+    def mark_verified(self, prev_hash, block):
+        key = (block.hash, block.fingerprint)
+        # re-inserted so it counts as the newest, dicts keep insertion order
+        self.verified.pop(key, None)
+        self.verified[key] = prev_hash
+        while len(self.verified) > self.max_verified:
+            del self.verified[next(iter(self.verified))]
+
+    def known_good(self, run):
+        """(hash, fingerprint) -> prev_hash for the candidates of `run` that already passed, for `check_chain`"""
+        known = {}
+        for _, candidates in run:
+            for block in candidates:
+                key = (block.hash, block.fingerprint)
+                if key in self.verified:
+                    known[key] = self.verified[key]
+        return known
+
+    def remember(self, seen, key):
+        # bounded, the cache only saves work, dropping it is safe
+        if len(seen) >= self.max_remembered:
+            seen.clear()
+        seen.add(key)
+
+    def pop(self, height, default=None):
+        return self.heights.pop(height, default)
+
+    def clear(self):
+        self.heights.clear()
+
+    def items(self):
+        return self.heights.items()
+
+    def __contains__(self, height):
+        return height in self.heights
+
+    def __len__(self):
+        return len(self.heights)
+
+    def __repr__(self):
+        return "{" + ", ".join(f"{height}: {list(candidates)}" for height, candidates in sorted(self.heights.items())) + "}"
@@ -1,13 +1,27 @@
 import sqlite3
 import json
 
+from peer_log import fields, get_logger
+
+log = get_logger("db")
+
 class SQLDatabase:
     def __init__(self, db_name="blocks.db"):
         # Connect to the database and create a cursor
-        self.conn = sqlite3.connect(db_name)
+        # the listen thread and the event queue thread both end up writing, calls are serialized by the peer
+        self.conn = sqlite3.connect(db_name, check_same_thread=False)
         self.cursor = self.conn.cursor()
+        self.tune()
         self.create_table()
 
+    def tune(self):
+        # WAL lets readers run alongside the writer, NORMAL sync is safe under WAL and skips an fsync per commit
+        self.cursor.execute("PRAGMA journal_mode=WAL")
+        self.cursor.execute("PRAGMA synchronous=NORMAL")
+        self.cursor.execute("PRAGMA temp_store=MEMORY")
+        self.cursor.execute("PRAGMA cache_size=-16000")  # ~16MB page cache
+        self.cursor.execute("PRAGMA mmap_size=268435456")  # 256MB
+
     def create_table(self):
         # Create a table to store block data
         self.cursor.execute('''
@@ -22,11 +36,36 @@ class SQLDatabase:
                 timestamp INTEGER
             )
         ''')
+        # one row per block message, so a message lookup is an index seek instead of a scan over the json
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS messages (
+                height_key INTEGER,
+                position INTEGER,
+                message TEXT,
+                PRIMARY KEY (height_key, position)
+            ) WITHOUT ROWID
+        ''')
+        # every index implicitly ends in height_key, so filtered reads come back in height order
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS blocks_minedBy ON blocks (minedBy)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS blocks_timestamp ON blocks (timestamp)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS blocks_hash ON blocks (hash)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS messages_message ON messages (message, height_key)")
         self.conn.commit()
+        self.backfill_messages()
+
+    def backfill_messages(self):
+        """Fill `messages` for a db written before it existed"""
+        if self.conn.execute("SELECT 1 FROM messages LIMIT 1").fetchone() is not None:
+            return
+        rows = self.conn.execute("SELECT height_key, messages FROM blocks")
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO messages (height_key, position, message) VALUES (?, ?, ?)",
+                                  ((height_key, position, message) for height_key, messages in rows.fetchall()
+                                   for position, message in enumerate(json.loads(messages))))
 
     def add_block(self, block_obj):
         # Prepare the block data for insertion
-        height_key = block_obj["height_key"]
+        height_key = block_obj.get("height_key", block_obj["height"])
         block_type = block_obj["type"]
         block_hash = block_obj["hash"]
         height = block_obj["height"]
@@ -41,11 +80,152 @@ class SQLDatabase:
                 INSERT INTO blocks (height_key, type, hash, height, messages, minedBy, nonce, timestamp)
                 VALUES (?, ?, ?, ?, ?, ?, ?, ?)
             ''', (height_key, block_type, block_hash, height, messages, mined_by, nonce, timestamp))
+            self.cursor.execute("DELETE FROM messages WHERE height_key = ?", (height_key,))
+            self.cursor.executemany("INSERT INTO messages (height_key, position, message) VALUES (?, ?, ?)",
+                                    [(height_key, position, message)
+                                     for position, message in enumerate(block_obj["messages"])])
             self.conn.commit()
-            print(f"Block with height_key {height_key} added successfully.")
+            log.debug("block added", extra=fields(height=height_key))
         except sqlite3.IntegrityError:
-            print(f"Block with height_key {height_key} already exists. Duplicate not added.")
+            log.debug("duplicate block not added", extra=fields(height=height_key))
+
+    def add_blocks(self, block_objs):
+        """Write many verified blocks in one transaction, a block at an existing height replaces it"""
+        rows = [(block_obj.get("height_key", block_obj["height"]), block_obj["type"], block_obj["hash"],
+                 block_obj["height"], json.dumps(block_obj["messages"]), block_obj["minedBy"],
+                 block_obj["nonce"], block_obj["timestamp"])
+                for block_obj in block_objs]
+        if rows:
+            with self.conn:
+                self.conn.executemany('''
+                    INSERT OR REPLACE INTO blocks (height_key, type, hash, height, messages, minedBy, nonce, timestamp)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ''', rows)
+                # a replaced height may have had more messages than its new block
+                self.conn.executemany("DELETE FROM messages WHERE height_key = ?", [(row[0],) for row in rows])
+                self.conn.executemany("INSERT INTO messages (height_key, position, message) VALUES (?, ?, ?)",
+                                      [(row[0], position, message) for row, block_obj in zip(rows, block_objs)
+                                       for position, message in enumerate(block_obj["messages"])])
+        return len(rows)
+
+    def delete_from(self, height_key):
+        """Drop every block at `height_key` and above"""
+        with self.conn:
+            self.conn.execute("DELETE FROM blocks WHERE height_key >= ?", (height_key,))
+            self.conn.execute("DELETE FROM messages WHERE height_key >= ?", (height_key,))
+
+    def load_chain(self):
+        """Stored blocks as {height: block_json}, stopping at the first gap so the result is a contiguous prefix"""
+        return dict(self.iter_chain())
+
+    def iter_chain(self):
+        """`load_chain` as (height, block_json) pairs in height order, one row at a time"""
+        rows = self.conn.execute('''
+            SELECT height_key, type, hash, messages, minedBy, nonce, timestamp
+            FROM blocks ORDER BY height_key
+        ''')
+        expected = 0
+        for height_key, block_type, block_hash, messages, mined_by, nonce, timestamp in rows:
+            if height_key != expected:
+                break
+            expected += 1
+            yield height_key, {
+                "type": block_type,
+                "hash": block_hash,
+                "height": height_key,
+                "messages": json.loads(messages),
+                "minedBy": mined_by,
+                "nonce": nonce,
+                "timestamp": timestamp
+            }
 
     def close(self):
         # Close the database connection
-        self.conn.close()
\ No newline at end of file
+        self.conn.close()
+
+
+class ChainQuery:
+    """
+    Read side of a `SQLDatabase` file on its own read-only connection. Under WAL a reader never blocks the
+    peer's writes and sees the last commit when its statement started.
+    Every lookup is index backed and paged by keyset: a page is (blocks, cursor), pass the cursor back as
+    `after` for the next page, None means there are no more. `stream` walks all pages, one short read
+    per page, so a long scan doesn't hold a snapshot open.
+    """
+
+    def __init__(self, db_name="blocks.db"):
+        self.conn = sqlite3.connect(f"file:{db_name}?mode=ro", uri=True, check_same_thread=False)
+        self.conn.execute("PRAGMA query_only=ON")
+
+    def block(self, height):
+        rows = self.select("WHERE height_key = ?", (height,), "", 1)
+        return rows[0] if rows else None
+
+    def by_hash(self, block_hash):
+        return self.select("WHERE hash = ?", (block_hash,), "ORDER BY height_key", 10)
+
+    def tip(self):
+        row = self.conn.execute("SELECT MAX(height_key) FROM blocks").fetchone()
+        return row[0]
+
+    def range(self, start, end, after=None, limit=100):
+        """Blocks with `start` <= height < `end`"""
+        low = start if after is None else max(start, after + 1)
+        blocks = self.select("WHERE height_key >= ? AND height_key < ?", (low, end), "ORDER BY height_key", limit)
+        return blocks, self.cursor(blocks, limit, lambda block: block["height"])
+
+    def mined_by(self, name, after=None, limit=100):
+        """Blocks mined by `name`, oldest first, paged by height"""
+        blocks = self.select("WHERE minedBy = ? AND height_key > ?", (name, -1 if after is None else after),
+                             "ORDER BY height_key", limit)
+        return blocks, self.cursor(blocks, limit, lambda block: block["height"])
+
+    def time_range(self, start, end, after=None, limit=100):
+        """Blocks with `start` <= timestamp < `end` in timestamp order, paged by (timestamp, height)"""
+        after = (start, -1) if after is None else tuple(after)
+        blocks = self.select("WHERE timestamp >= ? AND timestamp < ? AND (timestamp, height_key) > (?, ?)",
+                             (start, end) + after, "ORDER BY timestamp, height_key", limit)
+        return blocks, self.cursor(blocks, limit, lambda block: (block["timestamp"], block["height"]))
+
+    def with_message(self, text, prefix=False, after=None, limit=100):
+        """Blocks with a message equal to `text`, or starting with it when `prefix`, paged by height"""
+        if prefix:
+            # a range on the message index, LIKE would need a case insensitive index to use it
+            condition, params = "message >= ? AND message < ?", (text, text + "\U0010ffff")
+        else:
+            condition, params = "message = ?", (text,)
+        blocks = self.select(f"WHERE height_key IN (SELECT height_key FROM messages WHERE {condition}) "
+                             "AND height_key > ?", params + (-1 if after is None else after,),
+                             "ORDER BY height_key", limit)
+        return blocks, self.cursor(blocks, limit, lambda block: block["height"])
+
+    def stream(self, query, *args, page_size=500):
+        """Every block of a paged query, e.g. `stream(query.mined_by, "alice")`"""
+        after = None
+        while True:
+            blocks, after = query(*args, after=after, limit=page_size)
+            yield from blocks
+            if after is None:
+                return
+
+    def select(self, where, params, order, limit):
+        rows = self.conn.execute(f'''
+            SELECT height_key, type, hash, messages, minedBy, nonce, timestamp
+            FROM blocks {where} {order} LIMIT ?
+        ''', params + (limit,))
+        return [{
+            "type": block_type,
+            "hash": block_hash,
+            "height": height_key,
+            "messages": json.loads(messages),
+            "minedBy": mined_by,
+            "nonce": nonce,
+            "timestamp": timestamp
+        } for height_key, block_type, block_hash, messages, mined_by, nonce, timestamp in rows]
+
+    @staticmethod
+    def cursor(blocks, limit, key):
+        return key(blocks[-1]) if len(blocks) == limit else None
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,83 @@
+"""
+Trusted (height, hash) anchors for fast sync.
+    python3 checkpoints.py --db blocks.db --out checkpoints.json [--interval 1000]
+exports anchors from a verified chain, `main.py --checkpoints checkpoints.json` syncs against them.
+"""
+import argparse
+import json
+
+from blockchain_sql import SQLDatabase
+
+# heights between two exported anchors, one anchor pins everything below it so they can be sparse
+CHECKPOINT_INTERVAL = 1000
+
+
+class Checkpoints:
+    """
+    height -> trusted block hash.
+    A candidate at an anchored height with any other hash is rejected without hashing, and since a block's
+    hash covers the hash of the block before it, a chain that passes an anchor agrees with everything below
+    it: consensus can't take us onto a fork below the top checkpoint.
+    This saves no hashing on the honest chain. Blocks carry no prev-hash or content digest besides their own
+    hash, so a block matching its anchor is still hashed, that alone binds its messages / minedBy / nonce /
+    timestamp to the anchored hash. Anchors are kept sparse (`CHECKPOINT_INTERVAL`) for the same reason.
+    """
+
+    def __init__(self, anchors=()):
+        self.hashes = {}
+        self.top = -1
+        for height, block_hash in anchors:
+            self.add(height, block_hash)
+
+    def add(self, height, block_hash):
+        self.hashes[height] = block_hash
+        self.top = max(self.top, height)
+
+    def covering(self, run):
+        """The anchors `check_chain` needs for `run`, small enough to ship to a worker"""
+        if not run or run[0][0] > self.top:
+            return {}
+        heights = range(run[0][0], min(run[-1][0], self.top) + 1)
+        if len(heights) > len(self.hashes):
+            return {height: block_hash for height, block_hash in self.hashes.items() if height in heights}
+        return {height: self.hashes[height] for height in heights if height in self.hashes}
+
+    @classmethod
+    def from_chain(cls, verified_blocks, tip, interval=CHECKPOINT_INTERVAL):
+        """Anchors every `interval` heights of a verified chain plus its last block"""
+        checkpoints = cls()
+        for height in list(range(0, tip, interval)) + ([tip - 1] if tip else []):
+            checkpoints.add(height, verified_blocks[height]["hash"])
+        return checkpoints
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls((height, block_hash) for height, block_hash in json.load(f))
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(sorted(self.hashes.items()), f)
+
+    def __len__(self):
+        return len(self.hashes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export checkpoints from a verified chain in the sqlite db")
+    parser.add_argument("--db", default="blocks.db")
+    parser.add_argument("--out", default="checkpoints.json")
+    parser.add_argument("--interval", type=int, default=CHECKPOINT_INTERVAL,
+                        help="anchor every Nth height (and the tip), each one pins the chain below it")
+    args = parser.parse_args()
+
+    db = SQLDatabase(args.db)
+    chain = db.load_chain()
+    db.close()
+    checkpoints = Checkpoints.from_chain(chain, len(chain), args.interval)
+    checkpoints.save(args.out)
+    print(f"{len(checkpoints)} checkpoints up to height {checkpoints.top} written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+JSON vs binary codec on the block-sync messages.
+    python3 codec_bench.py [iterations]
+"""
+import hashlib
+import json
+import sys
+import time
+
+import wire_codec
+
+
+def sample_messages():
+    """One of each message the binary codec covers, shaped like what the network sends"""
+    block_hash = hashlib.sha256(b"sample").hexdigest()[:-8] + "0" * 8
+    block = {
+        "type": "GET_BLOCK_REPLY",
+        "hash": block_hash,
+        "height": 12345,
+        "messages": [f"message number {i}" for i in range(10)],
+        "minedBy": "Prof!",
+        "nonce": "8396351273542",
+        "timestamp": 1700000000
+    }
+    return {
+        "GET_BLOCK": {"type": "GET_BLOCK", "height": 12345},
+        "GET_BLOCK_REPLY": block,
+        "ANNOUNCE": dict(block, type="ANNOUNCE"),
+        "STATS": {"type": "STATS"},
+        "STATS_REPLY": {"type": "STATS_REPLY", "host": "192.168.0.10", "port": 8999,
+                        "height": 12345, "hash": block_hash},
+    }
+
+
+def time_per_call(func, arg, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func(arg)
+    return (time.perf_counter() - start) / iterations
+
+
+def run(iterations=20000):
+    """{msg_type: {codec: {"bytes", "encode_us", "decode_us"}}}"""
+    results = {}
+    json_encode = lambda msg: json.dumps(msg).encode('utf-8')
+    json_decode = lambda data: json.loads(data.decode('utf-8'))
+    for msg_type, msg in sample_messages().items():
+        json_data = json_encode(msg)
+        binary_data = wire_codec.encode(msg)
+        assert wire_codec.decode(binary_data) == json_decode(json_data), msg_type
+        results[msg_type] = {
+            "json": {
+                "bytes": len(json_data),
+                "encode_us": time_per_call(json_encode, msg, iterations) * 1e6,
+                "decode_us": time_per_call(json_decode, json_data, iterations) * 1e6
+            },
+            "binary": {
+                "bytes": len(binary_data),
+                "encode_us": time_per_call(wire_codec.encode, msg, iterations) * 1e6,
+                "decode_us": time_per_call(wire_codec.decode, binary_data, iterations) * 1e6
+            }
+        }
+    return results
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print(f"{'message':<16}{'codec':<8}{'bytes':>7}{'encode us':>12}{'decode us':>12}")
+    for msg_type, codecs in run(iterations).items():
+        for codec, result in codecs.items():
+            print(f"{msg_type:<16}{codec:<8}{result['bytes']:>7}"
+                  f"{result['encode_us']:>12.2f}{result['decode_us']:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import heapq
+import time
+from collections import deque
+
+
+class ConsensusIndex:
+    """
+    STATS_REPLY claims, (height, hash) -> {(host, port), ...} like the old `received_stats` dict.
+        - a claim expires `ttl` seconds after the peer last reported that key, so keys of peers that
+          left or moved on drop out instead of piling up; a key with no supporters left is deleted
+        - every claim has the same ttl, so deadlines are queued in order and expiry only looks at
+          the expired ones
+        - the claims for the `pin`ned key (the chain being downloaded) are kept past their deadline
+          until it is unpinned, its hosts are still the ones to fetch from
+        - best key is kept in a heap ordered by (height, supporters), updated as claims come and go,
+          stale heap entries are skipped when they reach the top
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.supporters = {}
+        # ((host, port), key) -> deadline of the latest claim
+        self.deadlines = {}
+        # (deadline, (host, port), key) in the order they were set, stale once that claim was renewed
+        self.expiry = deque()
+        # (-height, -supporters, hash), an entry is current only while it matches `supporters`
+        self.heap = []
+        self.pinned = None
+
+    def add(self, host, port, key, now=None):
+        """Record / renew a claim, O(log n)"""
+        now = time.time() if now is None else now
+        self.expire(now)
+        peer = (host, port)
+        deadline = now + self.ttl
+        self.deadlines[(peer, key)] = deadline
+        self.expiry.append((deadline, peer, key))
+        supporters = self.supporters.get(key)
+        if supporters is None:
+            supporters = self.supporters[key] = set()
+        if peer not in supporters:
+            supporters.add(peer)
+            self.push(key)
+
+    def expire(self, now=None):
+        """Drop claims past their deadline, returns how many"""
+        now = time.time() if now is None else now
+        expired = 0
+        while self.expiry and self.expiry[0][0] < now:
+            deadline, peer, key = self.expiry.popleft()
+            if self.deadlines.get((peer, key)) != deadline or key == self.pinned:
+                continue
+            del self.deadlines[(peer, key)]
+            supporters = self.supporters[key]
+            supporters.discard(peer)
+            if supporters:
+                self.push(key)
+            else:
+                del self.supporters[key]
+            expired += 1
+        return expired
+
+    def pin(self, key):
+        """Keep the claims for `key` while it is the chain we sync from, the previous pin expires normally again"""
+        previous = self.pinned
+        self.pinned = key
+        if previous is not None and previous != key:
+            # its passed deadlines were skipped, queue them again so they go on the next `expire`
+            for peer in self.supporters.get(previous, ()):
+                deadline = self.deadlines[(peer, previous)]
+                self.expiry.append((deadline, peer, previous))
+
+    def best(self, bad=(), now=None):
+        """
+        Highest (height, hash) not in `bad`, most supporters breaks ties, None if there is none.
+        Keys found in `bad` leave the heap for good, so `bad` has to be a set that only grows (bad_consensus).
+        """
+        self.expire(now)
+        heap = self.heap
+        while heap:
+            neg_height, neg_support, block_hash = heap[0]
+            key = (-neg_height, block_hash)
+            supporters = self.supporters.get(key)
+            if supporters is not None and len(supporters) == -neg_support and key not in bad:
+                return key
+            # stale or bad, a key that gets (more) supporters again is pushed again
+            heapq.heappop(heap)
+        return None
+
+    def push(self, key):
+        heapq.heappush(self.heap, (-key[0], -len(self.supporters[key]), key[1]))
+        if len(self.heap) > 2 * len(self.supporters) + 64:
+            # mostly stale entries, rebuild from the current supporters
+            self.heap = [(-key[0], -len(supporters), key[1]) for key, supporters in self.supporters.items()]
+            heapq.heapify(self.heap)
+
+    def get(self, key, default=None):
+        return self.supporters.get(key, default)
+
+    def keys(self):
+        return self.supporters.keys()
+
+    def items(self):
+        return self.supporters.items()
+
+    def __getitem__(self, key):
+        return self.supporters[key]
+
+    def __contains__(self, key):
+        return key in self.supporters
+
+    def __len__(self):
+        return len(self.supporters)
+
+    def __repr__(self):
+        return repr(self.supporters)
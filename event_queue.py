@@ -1,10 +1,45 @@
+import heapq
+import itertools
+import threading
 import time
 
+from peer_log import fields, get_logger
+
+log = get_logger("events")
+
+
+class Event:
+    """A scheduled callback, handed back by `add_event` so it can be cancelled or rescheduled."""
+    __slots__ = ("time_to_run", "callback", "args", "interval", "cancelled", "queued", "seq")
+
+    def __init__(self, time_to_run, callback, args, interval, seq):
+        self.time_to_run = time_to_run
+        self.callback = callback
+        self.args = args
+        self.interval = interval
+        self.cancelled = False
+        # whether a live heap entry exists for this event
+        self.queued = False
+        # only the heap entry carrying the current seq is live, older ones are skipped
+        self.seq = seq
+
+
 class EventQueue:
 
     def __init__(self):
-        """events sorted by their `time_to_run`."""
-        self.events = []  # List of events
+        """events kept in a heap ordered by their `time_to_run`."""
+        self.events = []  # heap of (time_to_run, seq, event)
+        self.cond = threading.Condition()
+        self.counter = itertools.count()
+        self.stale_entries = 0
+        self.stopped = False
+        # scheduling lag = how late a callback started compared to its `time_to_run`
+        self.lag_count = 0
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+        self.lag_last = 0.0
+        # callbacks that raised, the event is still rescheduled
+        self.failures = 0
 
     def add_event(self, time_to_run, callback, args=None, interval=None):
         """
@@ -12,23 +47,121 @@ class EventQueue:
             callback (function): The function to call when the event runs.
             args (list, optional): Arguments required by function. Defaults to None.
             interval (float, optional): At what interval it should repeat if any. Defaults to None.
+            returns the Event, pass it to `cancel_event` or `reschedule_event`
         """
-        event = (time_to_run, callback, args or [], interval)
-        self.events.append(event)  # Add the event to the list
-        self.events.sort(key=lambda x: x[0])  # Sort by `time_to_run`
+        with self.cond:
+            event = Event(time_to_run, callback, args or [], interval, next(self.counter))
+            self.push(event)
+        return event
+
+    def cancel_event(self, event):
+        """Stop an event from running, repeating ones included"""
+        with self.cond:
+            event.cancelled = True
+            if event.queued:
+                event.queued = False
+                self.stale_entries += 1
+                self.compact()
+
+    def reschedule_event(self, event, time_to_run, interval=None):
+        """Move an event to a new `time_to_run`, optionally changing its interval"""
+        with self.cond:
+            event.cancelled = False
+            if interval is not None:
+                event.interval = interval
+            event.seq = next(self.counter)
+            if event.queued:
+                self.stale_entries += 1
+            self.push(event, time_to_run)
+            self.compact()
+
+    def push(self, event, time_to_run=None):
+        """Heap insert, wakes the runner if the new event is now the earliest. Caller holds `cond`"""
+        if time_to_run is not None:
+            event.time_to_run = time_to_run
+        event.queued = True
+        heapq.heappush(self.events, (event.time_to_run, event.seq, event))
+        if self.events[0][2] is event:
+            self.cond.notify()
+
+    def compact(self):
+        """Rebuild the heap once cancelled/rescheduled leftovers outnumber live events"""
+        if self.stale_entries > 64 and self.stale_entries > len(self.events) // 2:
+            self.events = [entry for entry in self.events
+                           if not entry[2].cancelled and entry[1] == entry[2].seq]
+            heapq.heapify(self.events)
+            self.stale_entries = 0
+
+    def pending(self):
+        """Number of live events waiting to run"""
+        with self.cond:
+            return len(self.events) - self.stale_entries
+
+    def lag_stats(self):
+        """Scheduling lag in seconds over every callback run so far"""
+        with self.cond:
+            return {
+                "count": self.lag_count,
+                "avg": self.lag_total / self.lag_count if self.lag_count else 0.0,
+                "max": self.lag_max,
+                "last": self.lag_last
+            }
+
+    def stop(self):
+        """Make `run` return once the current callback is done"""
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+
+    def next_due(self):
+        """Block until the earliest event is due and pop it, None once stopped"""
+        with self.cond:
+            while not self.stopped:
+                if not self.events:
+                    self.cond.wait()
+                    continue
+                time_to_run, seq, event = self.events[0]
+                # drop cancelled or rescheduled leftovers
+                if event.cancelled or seq != event.seq:
+                    heapq.heappop(self.events)
+                    self.stale_entries -= 1
+                    continue
+                delay = time_to_run - time.time()
+                if delay > 0:
+                    # sleep exactly until the deadline, `add_event` wakes us for anything earlier
+                    self.cond.wait(delay)
+                    continue
+                heapq.heappop(self.events)
+                event.queued = False
+                return event
+            return None
 
     def run(self):
         while True:
-            # Get the current time
-            current_time = time.time()
-            # Check if any events using the firsts start time
-            if self.events and self.events[0][0] <= current_time:
-                # Pop the one scheduled earliest
-                time_to_run, callback, args, interval = self.events.pop(0)
-                # Call the method
-                callback(*args)
-                # Reschedule it if interval given
-                if interval:
-                    self.add_event(current_time + interval, callback, args, interval)
-            # Sleep briefly to be safe
-            time.sleep(0.1)
\ No newline at end of file
+            event = self.next_due()
+            if event is None:
+                return
+            start_time = time.time()
+            lag = start_time - event.time_to_run
+            with self.cond:
+                self.lag_count += 1
+                self.lag_total += lag
+                self.lag_max = max(self.lag_max, lag)
+                self.lag_last = lag
+            # Call the method, a failing job is logged and keeps its schedule instead of ending the runner
+            try:
+                event.callback(*event.args)
+            except Exception as e:
+                with self.cond:
+                    self.failures += 1
+                log.error("job failed", extra=fields(job=getattr(event.callback, '__name__', event.callback), error=e))
+            # Reschedule it if interval given, anchored to its slot so repeats don't drift
+            if event.interval:
+                with self.cond:
+                    # skip if cancelled, or already rescheduled from inside the callback
+                    if not event.cancelled and not event.queued:
+                        next_run = event.time_to_run + event.interval
+                        if next_run <= start_time:
+                            # fell a whole interval behind, skip the missed runs
+                            next_run = start_time + event.interval
+                        self.push(event, next_run)
@@ -0,0 +1,63 @@
+import time
+
+
+class ForkFinder:
+    """
+    Finds the highest height where a new consensus chain still matches our verified chain,
+    probing one height at a time with GET_BLOCK.
+    A block hash covers the previous hash, so a match at height h means the chains agree on 0..h.
+    Probes gallop down from the top (top-1, top-2, top-4, ...) and then bisect, so a chain that
+    extends ours is settled with a single probe and a deep fork with O(log n) probes.
+    """
+
+    def __init__(self, top, timeout=2.0):
+        # highest height known to match, -1 = not even the genesis block
+        self.lo = -1
+        # lowest height known (or assumed) to differ
+        self.hi = top
+        self.step = 1
+        self.galloping = True
+        self.timeout = timeout
+        self.probe = None
+        self.deadline = 0
+        self.probes_sent = 0
+
+    def done(self):
+        return self.lo + 1 >= self.hi
+
+    def fork_height(self):
+        """First height to fetch from the new chain, everything below it is kept"""
+        return self.lo + 1
+
+    def next_probe(self):
+        """Height to ask for next, None once settled"""
+        if self.done():
+            return None
+        if self.galloping:
+            self.probe = max(self.hi - self.step, self.lo + 1)
+        else:
+            self.probe = (self.lo + self.hi) // 2
+        return self.probe
+
+    def due(self, now=None):
+        """Whether the current probe should be (re)sent"""
+        now = time.time() if now is None else now
+        return not self.done() and (self.probe is None or now >= self.deadline)
+
+    def sent(self, now=None):
+        now = time.time() if now is None else now
+        self.deadline = now + self.timeout
+        self.probes_sent += 1
+
+    def on_block(self, height, matches):
+        """Record the new chain's block at `height`, returns True if it answered the current probe"""
+        if height != self.probe:
+            return False
+        if matches:
+            self.lo = height
+            self.galloping = False
+        else:
+            self.hi = height
+            self.step *= 2
+        self.probe = None
+        return True
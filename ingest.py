@@ -0,0 +1,155 @@
+import multiprocessing
+import threading
+
+from functools import partial
+
+from peer import (DIFFICULTY, block_msg_valid, decode_datagram, log, make_socket, recv_batch, stat_msg_valid,
+                  validate_msg)
+from peer_log import fields
+
+
+def payload_checks(difficulty):
+    """Extra shape checks done in the workers, so junk never reaches the process that owns state"""
+    return {
+        "GET_BLOCK_REPLY": partial(block_msg_valid, difficulty=difficulty),
+        "ANNOUNCE": partial(block_msg_valid, difficulty=difficulty),
+        "STATS_REPLY": partial(stat_msg_valid, difficulty=difficulty),
+        "GET_BLOCKS_REPLY": lambda msg: isinstance(msg.get("blocks"), list),
+    }
+
+
+PAYLOAD_CHECKS = payload_checks(DIFFICULTY)
+
+
+def decode_event(data, addr, checks=PAYLOAD_CHECKS):
+    """Datagram to a typed event (host, port, msg_type, msg), None if it is malformed"""
+    try:
+        host, port, msg_type, msg = validate_msg(addr, decode_datagram(data))
+    except (ValueError, UnicodeDecodeError):
+        # json.JSONDecodeError is a ValueError too
+        return None
+    check = checks.get(msg_type)
+    if check is not None and not check(msg):
+        return None
+    return host, port, msg_type, msg
+
+
+def ingest_worker(host, port, events, batch_size, difficulty=DIFFICULTY):
+    """
+    Worker process: its own socket on the shared port (SO_REUSEPORT), the kernel spreads datagrams
+    over the sockets by source. Decodes and validates, forwards one list of events per drained batch.
+    """
+    sock = make_socket(host, port, reuse_port=True)
+    checks = payload_checks(difficulty)
+    recv_errors = 0
+    while True:
+        try:
+            batch = recv_batch(sock, batch_size)
+        except OSError:
+            # reported with the next batch, or on their own once a batch worth piled up
+            recv_errors += 1
+            if recv_errors >= batch_size:
+                events.put(([], 0, recv_errors))
+                recv_errors = 0
+            continue
+        decoded = [decode_event(data, addr, checks) for data, addr in batch]
+        good = [event for event in decoded if event is not None]
+        # (events, how many were dropped as malformed, recv errors since the last put)
+        events.put((good, len(decoded) - len(good), recv_errors))
+        recv_errors = 0
+
+
+class IngestPool:
+    """
+    Receive side for the threaded runtime:
+        - the peer's own socket is drained in batches by a listen thread, like `Peer.listen`
+        - optionally `workers` processes bind the same port with SO_REUSEPORT and do the decoding
+          and validation, only well-formed typed events cross over to this process
+    Both paths hand events to the peer's admission control, `Peer.run_handlers` runs them on one thread.
+    Malformed datagrams and recv errors from either path land in the peer's metrics, as with `Peer.listen`.
+    The peer has to be created with `reuse_port=True` when workers are used.
+    """
+
+    def __init__(self, peer, workers=0, batch_size=64):
+        self.peer = peer
+        self.workers = workers
+        self.batch_size = batch_size
+        self.events = multiprocessing.Queue(maxsize=4096)
+        self.processes = []
+        # counters, only touched by this process
+        self.received = 0
+        self.malformed = 0
+        self.recv_errors = 0
+        self.lock = threading.Lock()
+        self.checks = payload_checks(peer.difficulty)
+
+    def start(self):
+        for _ in range(self.workers):
+            process = multiprocessing.Process(target=ingest_worker, daemon=True,
+                                              args=(self.peer.host, self.peer.port, self.events, self.batch_size,
+                                                    self.peer.difficulty))
+            process.start()
+            self.processes.append(process)
+        self.peer.metrics.collector(self.collect_metrics)
+        threading.Thread(target=self.peer.run_handlers, daemon=True).start()
+        threading.Thread(target=self.listen, daemon=True).start()
+        threading.Thread(target=self.consume, daemon=True).start()
+        log.info("listening", extra=fields(port=self.peer.port, ingest_workers=self.workers))
+
+    def listen(self):
+        """Drain the peer's own socket, it gets its share of the port too"""
+        while True:
+            try:
+                batch = recv_batch(self.peer.socket, self.batch_size)
+            except OSError:
+                self.handle([], 0, 1)
+                continue
+            decoded = [decode_event(data, addr, self.checks) for data, addr in batch]
+            good = [event for event in decoded if event is not None]
+            self.handle(good, len(decoded) - len(good))
+
+    def consume(self):
+        """Events decoded by the worker processes"""
+        while True:
+            good, malformed, recv_errors = self.events.get()
+            self.handle(good, malformed, recv_errors)
+
+    def handle(self, good, malformed, recv_errors=0):
+        with self.lock:
+            self.received += len(good) + malformed
+            self.malformed += malformed
+            self.recv_errors += recv_errors
+        if malformed:
+            self.peer.metrics.inc("malformed_total", amount=malformed)
+        if recv_errors:
+            self.peer.metrics.inc("socket_errors_total", "recv", amount=recv_errors)
+        for host, port, msg_type, msg in good:
+            self.peer.admit(host, port, msg_type, msg)
+
+    def stats(self):
+        try:
+            backlog = self.events.qsize()
+        except NotImplementedError:
+            # macOS has no sem_getvalue
+            backlog = -1
+        with self.lock:
+            return {
+                "received": self.received,
+                "malformed": self.malformed,
+                "recv_errors": self.recv_errors,
+                "backlog": backlog
+            }
+
+    def collect_metrics(self):
+        """Collector for the pool, malformed datagrams and recv errors are already in the peer's own counters"""
+        stats = self.stats()
+        return [
+            ("ingest_received_total", "counter", "Datagrams received by the ingest pool", None,
+             {None: stats["received"]}),
+            ("ingest_backlog", "gauge", "Decoded batches waiting to cross from the workers", None,
+             {None: stats["backlog"]}),
+        ]
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
@@ -1,44 +1,149 @@
 from event_queue import EventQueue
 from peer import Peer
+from async_peer import AsyncPeer
+from parallel_verify import ParallelVerifier
+from miner import Miner
+from blockchain_sql import SQLDatabase
+from ingest import IngestPool
+from checkpoints import Checkpoints
+from metrics import event_queue_collector
+from peer_log import setup_logging
+import argparse
+import asyncio
 import threading
 import uuid
 import time
 
 
-def main():
-    # change Peer core fields here
-    my_peer = Peer(8993, "u-neeq name", str(uuid.uuid4()))
+def periodic_jobs(my_peer):
+    """(first run delay, interval, callback, args) shared by both runtimes"""
+    # with a parallel verifier nothing is verified on receive, so the tick has to keep up
+    verify_interval = 25 if my_peer.verifier is None else 2
+    jobs = [
+        # send gossip every 30 seconds
+        (1, 30, my_peer.send_gossip, None),
+        # check on gossipers every 30 seconds as a batch ~ debug
+        (33, 30, my_peer.check_gossipers, None),
+        # kick out gossipers after 60 second window, every 60 seconds
+        (61, 61, my_peer.kick_gossiper, None),
+        # ask for stats every 10 seconds
+        (7, 10, my_peer.send_stats, [my_peer.received_gossipers]),
+        # check on stats every 10 seconds as a batch ~ debug
+        (10, 10, my_peer.check_stats, None),
+        # do a consensus every 3 minutes as instructed
+        (25, 180, my_peer.do_consensus, None),
+        # top up block requests every second, also retries the ones that timed out
+        (30, 1, my_peer.send_get_blocks, None),
+        # verify block chain every 25 seconds to see if we have a complete chain
+        (45, verify_interval, my_peer.verify_block_chain, None),
+
+        # uncomment to see all the blocks, WARNING will take up alot of terminal space
+        # (40, 15, my_peer.check_block_tracker, None),
+        # uncomment to see verified chains blocks
+        # (60, 10, my_peer.check_verified_blocks, None),
+        # uncomment to see how many block replies are served from the reply cache
+        # (60, 30, my_peer.check_reply_cache, None),
+        # uncomment to see how many msgs admission control dropped / shed
+        # (60, 30, my_peer.check_admission, None),
+    ]
+    if my_peer.metrics_file:
+        # refresh the metrics file every 5 seconds
+        jobs.append((5, 5, my_peer.write_metrics, None))
+    return jobs
+
+
+def run_threaded(my_peer, ingest_workers=0):
     # create an EventQueue
     event_q = EventQueue()
+    my_peer.metrics.collector(event_queue_collector(event_q))
+
+    if ingest_workers > 0:
+        # worker processes share the port and decode, this process only runs handlers
+        IngestPool(my_peer, ingest_workers).start()
+    else:
+        # Start listening in a separate thread
+        threading.Thread(target=my_peer.listen, daemon=True).start()
+    if my_peer.miner is not None:
+        # keeps extending our chain, the nonce search itself runs in the miner's process pool
+        threading.Thread(target=my_peer.mine_forever, daemon=True).start()
 
-    # Start listening in a separate thread
-    threading.Thread(target=my_peer.listen, daemon=True).start()
-
-    # send gossip every 30 seconds
-    event_q.add_event(time.time() + 1, my_peer.send_gossip, None, 30)
-    # check on gossipers every 30 seconds as a batch ~ debug
-    event_q.add_event(time.time() + 33, my_peer.check_gossipers, None, 30)
-    # kick out gossipers after 60 second window, every 60 seconds
-    event_q.add_event(time.time() + 61, my_peer.kick_gossiper, None, 61)
-    # ask for stats every 10 seconds
-    event_q.add_event(time.time() + 7, my_peer.send_stats, [my_peer.received_gossipers], 10)
-    # check on stats every 10 seconds as a batch ~ debug
-    event_q.add_event(time.time() + 10, my_peer.check_stats, None, 10)
-    # do a consensus every 3 minutes as instructed
-    event_q.add_event(time.time() + 25, my_peer.do_consensus, None, 180)
-    # ask for blocks every 10 seconds
-    event_q.add_event(time.time() + 30, my_peer.send_get_blocks, None, 10)
-    # verify block chain every 25 seconds to see if we have a complete chain
-    event_q.add_event(time.time() + 45, my_peer.verify_block_chain, None, 25)
-
-    # uncomment to see all the blocks, WARNING will take up alot of terminal space
-    # event_q.add_event(time.time() + 40, my_peer.check_block_tracker, None, 15)
-    # uncomment to see verified chains blocks
-    # event_q.add_event(time.time() + 60, my_peer.check_verified_blocks, None, 10)
-    ###
+    now = time.time()
+    for delay, interval, callback, args in periodic_jobs(my_peer):
+        event_q.add_event(now + delay, callback, args, interval)
 
     while True:
         event_q.run()
 
+
+def run_async(my_peer):
+    asyncio.run(my_peer.serve(periodic_jobs(my_peer)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Peer-to-peer blockchain peer")
+    parser.add_argument("--mode", choices=["threaded", "async"], default="threaded",
+                        help="threaded: listen thread + EventQueue, async: single asyncio loop")
+    parser.add_argument("--verify-workers", type=int, default=0,
+                        help="processes for parallel chain verification, 0 verifies blocks as they arrive")
+    parser.add_argument("--verify-batch", type=int, default=256,
+                        help="blocks per parallel verification task")
+    parser.add_argument("--ingest-workers", type=int, default=0,
+                        help="threaded mode: processes sharing the port via SO_REUSEPORT to decode incoming datagrams")
+    parser.add_argument("--db", default="blocks.db",
+                        help="sqlite file the verified chain is kept in across restarts, empty to disable")
+    parser.add_argument("--fanout", type=int, default=3,
+                        help="peers each GOSSIP is sent and forwarded to")
+    parser.add_argument("--bootstrap", action="append", metavar="HOST:PORT",
+                        help="peer to gossip with while we know no one (repeatable), defaults to the prof peers")
+    parser.add_argument("--difficulty", type=int, default=8,
+                        help="trailing hex zeros a block hash needs, lower it only for local test networks")
+    parser.add_argument("--mine-workers", type=int, default=0,
+                        help="processes mining new blocks on top of our verified chain, 0 disables mining")
+    parser.add_argument("--mine-message", action="append",
+                        help="message to put in mined blocks (repeatable, up to 10 of at most 20 chars)")
+    parser.add_argument("--checkpoints",
+                        help="json of trusted [height, hash] anchors, a chain that disagrees with one is never synced")
+    parser.add_argument("--metrics-file",
+                        help="file the metrics are written to in the Prometheus text format every 5 seconds")
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve the metrics on http://127.0.0.1:PORT/metrics")
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    parser.add_argument("--log-file", help="write the log here instead of stdout")
+    parser.add_argument("--log-json", action="store_true", help="one json object per log record")
+    args = parser.parse_args()
+
+    # a background thread writes the log, handlers and verification never wait on the terminal
+    setup_logging(args.log_level, args.log_file, args.log_json)
+
+    # change Peer core fields here
+    if args.mode == "async":
+        my_peer = AsyncPeer(8993, "u-neeq name", str(uuid.uuid4()))
+    else:
+        my_peer = Peer(8993, "u-neeq name", str(uuid.uuid4()), reuse_port=args.ingest_workers > 0)
+    my_peer.difficulty = args.difficulty
+    my_peer.gossip_fanout = args.fanout
+    if args.bootstrap:
+        my_peer.bootstrap_peers = [(host, int(port)) for host, port in
+                                   (address.rsplit(":", 1) for address in args.bootstrap)]
+    if args.verify_workers > 0:
+        my_peer.verifier = ParallelVerifier(args.verify_workers, args.verify_batch, args.difficulty)
+    if args.mine_workers > 0:
+        my_peer.miner = Miner(args.mine_workers, args.difficulty)
+        if args.mine_message:
+            my_peer.mine_messages = args.mine_message
+    if args.checkpoints:
+        my_peer.checkpoints = Checkpoints.load(args.checkpoints)
+    my_peer.metrics_file = args.metrics_file
+    if args.metrics_port:
+        my_peer.metrics.serve(args.metrics_port)
+    if args.db:
+        # warm start, only blocks above the stored tip get fetched
+        my_peer.attach_db(SQLDatabase(args.db))
+
+    if args.mode == "async":
+        run_async(my_peer)
+    else:
+        run_threaded(my_peer, args.ingest_workers)
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,175 @@
+"""
+Counters, latency histograms and gauges, exported in the Prometheus text format to a file or a
+loopback HTTP endpoint. Updates are a dict lookup and an add (a bisect for histograms) without a lock,
+cheap enough to leave on; at worst a concurrent update is lost, fine for monitoring.
+Gauges are pulled from collector callbacks only when the metrics are rendered.
+"""
+import os
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# seconds, handlers are mostly microseconds, a verification run or a consensus can take much longer
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # one per bucket plus +Inf, not cumulative, `render` adds them up
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """
+    Registry of metrics, each described once with `describe` and then updated by name:
+        inc("messages_received_total", "GOSSIP")      counter, optionally split by one label
+        observe("handler_seconds", 0.0002, "GOSSIP")   histogram
+        collector(func)                                func() -> [(name, kind, help, label, {label value: value})]
+    Every name gets `prefix` in front when rendered.
+    """
+
+    def __init__(self, prefix="p2p_"):
+        self.prefix = prefix
+        # name -> (kind, help, label name or None)
+        self.descriptions = {}
+        # name -> {label value or None: value / Histogram}
+        self.series = {}
+        self.collectors = []
+        self.server = None
+
+    def describe(self, name, kind, help_text, label=None, buckets=LATENCY_BUCKETS):
+        self.descriptions[name] = (kind, help_text, label)
+        self.series[name] = {}
+        if kind == "histogram":
+            self.series[name] = HistogramSeries(buckets)
+
+    def inc(self, name, label_value=None, amount=1):
+        series = self.series[name]
+        series[label_value] = series.get(label_value, 0) + amount
+
+    def observe(self, name, value, label_value=None):
+        self.series[name].get_histogram(label_value).observe(value)
+
+    def collector(self, func):
+        self.collectors.append(func)
+
+    def render(self):
+        """Everything in the Prometheus text exposition format"""
+        lines = []
+        for name, (kind, help_text, label) in self.descriptions.items():
+            self.render_family(lines, name, kind, help_text, label, self.series[name])
+        for func in self.collectors:
+            for name, kind, help_text, label, values in func():
+                self.render_family(lines, name, kind, help_text, label, values)
+        return "\n".join(lines) + "\n"
+
+    def render_family(self, lines, name, kind, help_text, label, values):
+        full_name = self.prefix + name
+        lines.append(f"# HELP {full_name} {help_text}")
+        lines.append(f"# TYPE {full_name} {kind}")
+        for label_value, value in list(values.items()):
+            labels = [] if label is None else [f'{label}="{escape(label_value)}"']
+            if kind != "histogram":
+                lines.append(f"{full_name}{format_labels(labels)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(value.buckets + (float("inf"),), value.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                bucket_labels = format_labels(labels + ['le="' + le + '"'])
+                lines.append(f"{full_name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{full_name}_sum{format_labels(labels)} {value.sum}")
+            lines.append(f"{full_name}_count{format_labels(labels)} {value.count}")
+
+    def write(self, path):
+        """Write `render()` to `path`, replaced atomically so a scraper never reads half a file"""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+    def serve(self, port, host="127.0.0.1"):
+        """Serve `render()` on http://host:port/metrics from a daemon thread"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server
+
+
+class HistogramSeries(dict):
+    """label value -> Histogram, created on first use"""
+
+    def __init__(self, buckets):
+        super().__init__()
+        self.buckets = buckets
+
+    def get_histogram(self, label_value):
+        histogram = self.get(label_value)
+        if histogram is None:
+            histogram = self[label_value] = Histogram(self.buckets)
+        return histogram
+
+
+def format_labels(labels):
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def udp_drops(port):
+    """Datagrams the kernel dropped for the UDP socket bound to `port` (Linux /proc/net/udp), None elsewhere"""
+    drops = None
+    for path in ("/proc/net/udp", "/proc/net/udp6"):
+        try:
+            with open(path) as f:
+                next(f)
+                for line in f:
+                    fields = line.split()
+                    if int(fields[1].rsplit(":", 1)[1], 16) == port:
+                        drops = (drops or 0) + int(fields[-1])
+        except (OSError, ValueError, IndexError, StopIteration):
+            continue
+    return drops
+
+
+def event_queue_collector(event_queue):
+    """Collector for an EventQueue's scheduling lag and backlog"""
+    def collect():
+        lag = event_queue.lag_stats()
+        return [
+            ("event_queue_lag_seconds", "gauge", "Delay between an event's due time and its callback starting",
+             "stat", {"avg": lag["avg"], "max": lag["max"], "last": lag["last"]}),
+            ("event_queue_runs_total", "counter", "Callbacks run by the event queue", None, {None: lag["count"]}),
+            ("event_queue_pending", "gauge", "Events waiting to run", None, {None: event_queue.pending()}),
+            ("event_queue_failures_total", "counter", "Callbacks that raised, their event keeps running", None,
+             {None: event_queue.failures}),
+        ]
+    return collect
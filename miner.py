@@ -0,0 +1,132 @@
+"""
+Proof-of-work miner for blocks in the layout `verification` checks:
+    sha256(prev_hash | minedBy | messages... | timestamp as 8 bytes big-endian | nonce)
+Everything before the nonce is fixed for a block, so each worker hashes it once and copies that
+state for every nonce it tries.
+    python3 miner.py [--difficulty D] [--workers N] [--blocks B]    mines B blocks on top of each other, reports H/s
+"""
+import argparse
+import hashlib
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from peer import verification
+
+
+def block_prefix(prev_hash, mined_by, messages, timestamp):
+    """The bytes hashed before the nonce"""
+    return b"".join([prev_hash.encode(), mined_by.encode()] + [message.encode() for message in messages] +
+                    [timestamp.to_bytes(8, 'big')])
+
+
+def search(prefix, start, stop, difficulty):
+    """
+    Worker side: try nonces start..stop-1, returns (nonce, hash, hashes tried), nonce/hash None if none fit.
+    A hash "ends in `difficulty` zeros" as hex, so the trailing bytes of the raw digest are compared instead.
+    """
+    midstate = hashlib.sha256(prefix)
+    full, odd = divmod(difficulty, 2)
+    zeros = bytes(full)
+    for nonce in range(start, stop):
+        state = midstate.copy()
+        state.update(b"%d" % nonce)
+        digest = state.digest()
+        if digest.endswith(zeros) and not (odd and digest[-full - 1] & 0x0F):
+            return str(nonce), digest.hex(), nonce - start + 1
+    return None, None, stop - start
+
+
+class Miner:
+    """
+    Searches nonces for a block across a process pool, `workers` chunks of `chunk` nonces in flight,
+    a finished chunk is replaced by the next one until a nonce fits or `should_stop` says the block is stale.
+    """
+
+    def __init__(self, workers=None, difficulty=8, chunk=100000):
+        self.workers = workers or os.cpu_count() or 1
+        self.difficulty = difficulty
+        self.chunk = chunk
+        self.pool = ProcessPoolExecutor(max_workers=self.workers)
+        # totals over every `mine` call, for `hash_rate`
+        self.hashes = 0
+        self.seconds = 0.0
+        # the last `mine` call alone
+        self.last_rate = 0.0
+
+    def mine(self, prev_hash, height, messages, mined_by, timestamp=None, should_stop=None):
+        """
+        A GET_BLOCK_REPLY block at `height` on top of `prev_hash`, None if `should_stop()` turned True first
+        (checked every time a chunk finishes).
+        """
+        if not (1 <= len(messages) <= 10) or any(len(message) > 20 for message in messages):
+            raise ValueError("a block carries 1 to 10 messages of at most 20 characters")
+        timestamp = int(time.time()) if timestamp is None else timestamp
+        prefix = block_prefix(prev_hash, mined_by, messages, timestamp)
+        start = time.perf_counter()
+        hashes = 0
+        next_nonce = 0
+        found = None
+        running = set()
+        try:
+            while found is None:
+                while len(running) < self.workers:
+                    running.add(self.pool.submit(search, prefix, next_nonce, next_nonce + self.chunk,
+                                                 self.difficulty))
+                    next_nonce += self.chunk
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    nonce, block_hash, tried = future.result()
+                    hashes += tried
+                    if nonce is not None and (found is None or int(nonce) < int(found[0])):
+                        found = (nonce, block_hash)
+                if found is None and should_stop is not None and should_stop():
+                    return None
+        finally:
+            for future in running:
+                future.cancel()
+            elapsed = time.perf_counter() - start
+            self.hashes += hashes
+            self.seconds += elapsed
+            self.last_rate = hashes / elapsed if elapsed > 0 else 0.0
+        nonce, block_hash = found
+        return {
+            "type": "GET_BLOCK_REPLY",
+            "hash": block_hash,
+            "height": height,
+            "messages": list(messages),
+            "minedBy": mined_by,
+            "nonce": nonce,
+            "timestamp": timestamp
+        }
+
+    def hash_rate(self):
+        """Hashes per second over everything mined so far"""
+        return self.hashes / self.seconds if self.seconds > 0 else 0.0
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mine blocks and report the hash rate")
+    parser.add_argument("--difficulty", type=int, default=5, help="trailing hex zeros of a block hash")
+    parser.add_argument("--workers", type=int, default=0, help="mining processes, 0 = one per cpu")
+    parser.add_argument("--blocks", type=int, default=3, help="blocks to mine on top of each other")
+    args = parser.parse_args()
+
+    miner = Miner(args.workers, args.difficulty)
+    prev_hash = ""
+    try:
+        for height in range(args.blocks):
+            block = miner.mine(prev_hash, height, ["bench"], "miner.py")
+            assert verification(prev_hash, block, args.difficulty)
+            print(f"height {height}: nonce {block['nonce']} {block['hash']}, {miner.last_rate:,.0f} H/s")
+            prev_hash = block["hash"]
+        print(f"{miner.workers} workers, difficulty {args.difficulty}: {miner.hash_rate():,.0f} H/s overall")
+    finally:
+        miner.close()
+
+
+if __name__ == "__main__":
+    main()
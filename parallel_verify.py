@@ -0,0 +1,75 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from peer import off_anchor, verification
+
+
+def check_batch(jobs, difficulty):
+    """Worker side: jobs = [(prev_hash, Block), ...] -> [bool, ...]"""
+    return [verification(prev_hash, block, difficulty) for prev_hash, block in jobs]
+
+
+class ParallelVerifier:
+    """
+    Verifies a run of heights across a process pool.
+    A block's hash only depends on its own fields and the hash of the block before it, so every
+    (claimed prev_hash, candidate) pair of the run is hashed in parallel. A cheap sequential pass
+    then picks the candidate at each height that links to the one picked below it.
+    Same inputs and result as `check_chain`, so it can be dropped in for it.
+    """
+
+    def __init__(self, workers=None, batch_size=256, difficulty=8):
+        self.workers = workers or os.cpu_count() or 1
+        # (prev_hash, block) pairs per pool task, runs shorter than this are not worth the pool
+        self.batch_size = batch_size
+        self.difficulty = difficulty
+        self.pool = ProcessPoolExecutor(max_workers=self.workers)
+
+    def verify_run(self, prev_hash, run, known_good=None, anchors=None):
+        """
+        run = [(height, [Block, ...]), ...] contiguous and in order, `prev_hash` links to its first height
+        known_good: (hash, fingerprint) -> prev_hash of blocks that already passed, they are not hashed again
+        anchors: height -> trusted hash, as in `check_chain`
+        returns ([verified Block, ...], first bad height or None)
+        """
+        known_good = known_good or {}
+        anchors = anchors or {}
+        jobs = []
+        passed = set()
+        # the hashes a candidate at each height may link to, first height links to `prev_hash` only
+        prev_hashes = [prev_hash]
+        for height_key, candidates in run:
+            for index, block in enumerate(candidates):
+                if off_anchor(anchors, height_key, block):
+                    continue
+                for claimed_prev in prev_hashes:
+                    if known_good.get((block.hash, block.fingerprint)) == claimed_prev:
+                        passed.add((height_key, index, claimed_prev))
+                    else:
+                        jobs.append((height_key, index, claimed_prev, block))
+            prev_hashes = list({block.hash for block in candidates})
+
+        batches = [jobs[i:i + self.batch_size] for i in range(0, len(jobs), self.batch_size)]
+        results = self.pool.map(check_batch,
+                                [[(claimed_prev, block) for _, _, claimed_prev, block in batch]
+                                 for batch in batches],
+                                [self.difficulty] * len(batches))
+        for batch, outcome in zip(batches, results):
+            for (height_key, index, claimed_prev, _), ok in zip(batch, outcome):
+                if ok:
+                    passed.add((height_key, index, claimed_prev))
+
+        # sequential link pass, no hashing
+        verified = []
+        for height_key, candidates in run:
+            for index, block in enumerate(candidates):
+                if (height_key, index, prev_hash) in passed:
+                    verified.append(block)
+                    prev_hash = block.hash
+                    break
+            else:
+                return verified, height_key
+        return verified, None
+
+    def close(self):
+        self.pool.shutdown()
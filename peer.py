@@ -1,24 +1,95 @@
 import hashlib
 import socket
 import json
+import logging
+import random
+import threading
 import time
 
+from admission import AdmissionControl
+from block_download import BlockDownloadScheduler
+from block_store import ADDED, REJECTED, Block, BlockStore
+from checkpoints import CHECKPOINT_INTERVAL, Checkpoints
+from consensus_index import ConsensusIndex
+from fork_finder import ForkFinder
+from metrics import Metrics, udp_drops
+from peer_log import fields, get_logger
+from peer_table import PeerTable, SeenCache
+from reply_cache import ReplyCache
+from tiered_store import TieredChain
+import wire_codec
+
+# well known peers gossip starts from while we know no one else
+PROF_PEERS = [
+    ("silicon.cs.umanitoba.ca", 8999),
+    ("eagle.cs.umanitoba.ca", 8999),
+    ("hawk.cs.umanitoba.ca", 8999),
+    ("grebe.cs.umanitoba.ca", 8999),
+    ("goose.cs.umanitoba.ca", 8999)
+]
+# peers each GOSSIP is sent / forwarded to, every peer is reached in O(log n) hops
+GOSSIP_FANOUT = 3
+# trailing hex zeros a block hash needs, 8 on the real network, lower it to mine/test locally
+DIFFICULTY = 8
+# largest UDP payload, anything smaller silently truncates big block replies
+RECV_BUFFER_SIZE = 65535
+# kernel receive queue, absorbs gossip / block reply bursts while we are busy
+SOCKET_RCVBUF = 4 * 1024 * 1024
+# datagrams drained from the socket per wakeup
+RECV_BATCH = 64
+# largest GET_BLOCKS_REPLY datagram we build, several go out when the blocks don't fit in one
+REPLY_MTU = 1200
+# most blocks served for one GET_BLOCKS, what our own downloader asks for in one run (`range_chunk`),
+# any more and a small spoofed request turns us into a reflection amplifier
+MAX_BLOCKS_PER_REQUEST = 64
+# most STATS sent per `send_stats` tick, the next tick carries on with the rest of the table
+STATS_FANOUT = 256
+# newest verified blocks kept as dicts, older ones are read from an mmap'd segment
+HOT_BLOCKS = 2048
+# msg types with a handler, anything else is counted as "other" so junk can't grow the label set
+HANDLED_TYPES = {"GOSSIP", "GOSSIP_REPLY", "STATS", "STATS_REPLY", "GET_BLOCK", "GET_BLOCK_REPLY",
+                 "GET_BLOCKS", "GET_BLOCKS_REPLY", "CONSENSUS", "ANNOUNCE"}
+
+log = get_logger("peer")
+# verification() runs in worker processes too, there it stays silent
+verify_log = get_logger("verify")
+
 
 class Peer:
-    def __init__(self, port, name, gossip_id):
-        # Automatically pick up the current IP
-        self.host = self.get_local_ip()
+    def __init__(self, port, name, gossip_id, reuse_port=False, bootstrap_peers=None, host=None):
+        # Automatically pick up the current IP, unless given one (e.g. loopback for the simulator)
+        self.host = host or self.get_local_ip()
         # port is assigned in main
         self.port = port
         # name is assigned in main
         self.name = name
         # gossip id is created once for session in main using uuid
         self.gossip_id = gossip_id
-        # UDP Socket
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.socket.bind((self.host, self.port))
-        # collect all gossip reply with host:port as key
-        self.received_gossipers = {}
+        # each GOSSIP round gets its own id, `gossip_id:round`
+        self.gossip_round = 0
+        # (host, port) gossip falls back on while the peer table is smaller than the fanout
+        self.bootstrap_peers = list(PROF_PEERS if bootstrap_peers is None else bootstrap_peers)
+        self.gossip_fanout = GOSSIP_FANOUT
+        # ids of GOSSIP already handled, so each one is answered and forwarded once
+        self.seen_gossip = SeenCache()
+        # UDP Socket, `reuse_port` lets ingest workers bind the same port
+        self.socket = make_socket(self.host, self.port, reuse_port)
+        # advertise and use the compact binary codec with peers that support it
+        self.binary_codec = True
+        # GET_BLOCKS_REPLY datagrams are packed up to this size
+        self.mtu = REPLY_MTU
+        # rate limits and prioritizes received msgs before a handler runs them, see `receive` / `run_handlers`
+        self.admission = AdmissionControl()
+        # encoded GET_BLOCK_REPLY / STATS_REPLY datagrams, verified blocks never change once served
+        self.reply_cache = ReplyCache(max_entries=4 * HOT_BLOCKS)
+        # collect all gossip reply with host:port as key, expire 60s after the last one
+        self.received_gossipers = PeerTable(ttl=60)
+        # (host, port) of gossipers that advertised the binary codec / GET_BLOCKS range requests in their latest
+        # GOSSIP / GOSSIP_REPLY, views of the table so a capability goes when its gossiper expires
+        self.binary_peers = self.received_gossipers.with_feature(wire_codec.CODEC_NAME)
+        self.range_peers = self.received_gossipers.with_feature("GET_BLOCKS")
+        # STATS per `send_stats` tick
+        self.stats_fanout = STATS_FANOUT
         """
         an object containing a tuple key with host and port arrays inside a set
             {
@@ -26,7 +97,7 @@ class Peer:
                 [height1, hash1]: ([host1,port1], [host2,port2])
             }
         """
-        self.received_stats = {}
+        self.received_stats = ConsensusIndex(ttl=60)
         """
             we retain the result key of consensus 
                 and plug it back in `received_stats` to get the host_port sets 
@@ -35,67 +106,160 @@ class Peer:
         # default consensus (height, last_block_hash)
         self.consensus_key = (-1, "")
         # collect all bad consesnus here to cross against when doing new consensus
-        self.bad_consensus = []
-        # maintain requested block heights here, avoid dups
-        self.requested_block_heights = set()
+        self.bad_consensus = set()
+        # decides which peer gets asked for which height, one request in flight per height
+        self.downloader = BlockDownloadScheduler()
+        # the consensus the downloader is currently working towards
+        self.download_key = (-1, "")
         """
-            the below will have the following format
+            unverified candidates, deduplicated by claimed hash
             {
-                0: (BLOCK_REPLY_1.json, BLOCK_REPLY_2.json, BLOCK_REPLY_3.json)
-                1: (BLOCK_REPLY_1.json, BLOCK_REPLY_2.json)
+                0: {hash1: Block, hash2: Block, hash3: Block}
+                1: {hash1: Block, hash2: Block}
                 ...
             }
             once verified we push it to verified_blocks
-            and then sql it. think
+            and then sql it.
         """
-        self.block_tracker = {}
+        # the verified memo covers the hot window, where forks and resyncs roll the tip back
+        self.block_tracker = BlockStore(max_verified=HOT_BLOCKS)
         """
-            the below will have the following format
+            the below will have the following format, the newest HOT_BLOCKS as dicts, see TieredChain
             {
                 0: [BLOCK_REPLY_1.json]
                 1: [BLOCK_REPLY_2.json]
                 ...
             }
         """
-        self.verified_blocks = {}
+        self.verified_blocks = TieredChain(HOT_BLOCKS)
+        # next height to verify, everything below it is in verified_blocks
+        self.verified_tip = 0
+        # height -> how many rounds of candidates failed verification there
+        self.failed_verifications = {}
+        # serializes every writer of the chain state (tip, verified_blocks, block_tracker, fork_finder, consensus_key):
+        # add_block (listen thread) and the verify tick (event thread) both advance the tip, and a consensus from
+        # either thread can switch chains; reentrant, a failed verification runs a consensus while holding it
+        self.verify_lock = threading.RLock()
+        # optional ParallelVerifier, when set long runs are hashed across a process pool by the verify tick
+        self.verifier = None
+        # trusted (height, hash) anchors, a chain disagreeing with one of them is never verified
+        self.checkpoints = Checkpoints()
+        # proof-of-work difficulty checked on every block, and used by the miner
+        self.difficulty = DIFFICULTY
+        # optional Miner, when set `mine_forever` extends our verified chain with `mine_messages`
+        self.miner = None
+        self.mine_messages = ["hi from " + name[:12]]
+        # optional SQLDatabase the verified chain is persisted to, see `attach_db`
+        self.db = None
+        # verified blocks not written to the db yet, flushed in batches
+        self.unsaved_blocks = []
+        # height the current resync started from on top of an already verified prefix
+        self.resync_base = 0
+        # active ForkFinder while we look for where the new consensus chain leaves ours
+        self.fork_finder = None
         # flag to alert whether consensus is being done
         self.currently_verifying_flag = False
         # flag to alert whether we have complete chain
         self.verified_chain_flag = False
-        print(f"Peer started at {self.host}:{self.port}, The name: {name}")
+        # counters / histograms updated on the hot paths, gauges read by `collect_metrics` on export
+        self.metrics = Metrics()
+        self.describe_metrics()
+        # Prometheus text file `write_metrics` keeps up to date, None disables it
+        self.metrics_file = None
+        # verification passes since the last `verify_block_chain` summary line
+        self.verify_passes = {"passes": 0, "blocks": 0, "failed": 0}
+        log.info("peer started", extra=fields(host=self.host, port=self.port, name=name))
 
     def get_local_ip(self):
         hostname = socket.gethostname()
         return socket.gethostbyname(hostname)
 
+    def send_to(self, data, host, port):
+        """Single exit point for outgoing datagrams, the asyncio runtime swaps in its transport"""
+        try:
+            self.socket.sendto(data, (host, port))
+        except OSError:
+            self.metrics.inc("socket_errors_total", "send")
+            raise
+
+    def send_quietly(self, data, host, port):
+        """`send_to` for fan-out loops, a target that can't be resolved or reached doesn't stop the rest"""
+        try:
+            self.send_to(data, host, port)
+            return True
+        except OSError as e:
+            # counted by send_to
+            log.debug("send failed", extra=fields(host=host, port=port, error=e))
+            return False
+
     def listen(self):
-        """Listen for incoming msgs."""
-        print("Listening for incoming messages...")
+        """Listen for incoming msgs, the handlers run on their own thread"""
+        log.info("listening", extra=fields(port=self.port))
+        threading.Thread(target=self.run_handlers, daemon=True).start()
         while True:
             try:
-                data, addr = self.socket.recvfrom(1024)
-                if data:
+                for data, addr in recv_batch(self.socket):
                     try:
-                        msg = json.loads(data.decode('utf-8'))  # Decode JSON
-                        self.handle_msg(addr, msg)  # Process the message
+                        msg = decode_datagram(data)  # Decode JSON
+                        self.receive(addr, msg)  # Queue it for the handlers
                     except json.JSONDecodeError as e:
                         # print(f"Invalid JSON received from {addr}: {data}. Error: {e}")
-                        pass
-
-                else:
-                    # print(f"--LISTENING--\n\t{addr}: \n\t\tNO DATA\n")
-                    pass
+                        self.metrics.inc("malformed_total")
+                    except Exception as e:
+                        # print(f"Error while handling data: {e}")
+                        self.metrics.inc("malformed_total")
 
             except Exception as e:
                 # print(f"Error while receiving data: {e}")
-                pass
+                self.metrics.inc("socket_errors_total", "recv")
 
     def handle_msg(self, addr, msg):
         """Handle received msgs."""
         host, port, msg_type, message = validate_msg(addr, msg)
+        self.dispatch(host, port, msg_type, message)
+
+    def receive(self, addr, msg):
+        """Validate a received msg and hand it to admission control instead of running it inline"""
+        host, port, msg_type, message = validate_msg(addr, msg)
+        self.admit(host, port, msg_type, message)
+
+    def admit(self, host, port, msg_type, message):
+        """Queue an already validated msg, dropped if its source is over budget or the queue is full"""
+        self.admission.offer((host, port, msg_type, message), host, port, msg_type,
+                             self.solicited(host, port, msg_type, message))
+
+    def solicited(self, host, port, msg_type, message):
+        """Block replies from a host we have requests in flight with, or the fork probe answer"""
+        if msg_type not in ("GET_BLOCK_REPLY", "GET_BLOCKS_REPLY"):
+            return False
+        if self.downloader.awaiting((host, port)):
+            return True
+        fork_finder = self.fork_finder
+        return fork_finder is not None and fork_finder.probe is not None and message.get("height") == fork_finder.probe
 
+    def run_handlers(self):
+        """Handler thread: runs admitted msgs, most important first"""
+        while True:
+            for host, port, msg_type, message in self.admission.take():
+                try:
+                    self.dispatch(host, port, msg_type, message)
+                except Exception as e:
+                    # print(f"Error while handling data: {e}")
+                    self.metrics.inc("handler_errors_total", type_label(msg_type))
+
+    def dispatch(self, host, port, msg_type, message):
+        """Run the handler for an already validated msg, counted and timed per msg type"""
+        label = type_label(msg_type)
+        self.metrics.inc("messages_received_total", label)
+        start = time.perf_counter()
+        try:
+            self.run_handler(host, port, msg_type, message)
+        finally:
+            self.metrics.observe("handler_seconds", time.perf_counter() - start, label)
+
+    def run_handler(self, host, port, msg_type, message):
         if msg_type == "GOSSIP":
-            self.send_gossip_reply(host, port)
+            self.add_gossip(host, port, message)
         elif msg_type == "GOSSIP_REPLY":
             self.add_gossiper(host, port, message)
         elif msg_type == "STATS_REPLY":
@@ -106,35 +270,72 @@ class Peer:
             self.send_block_reply(host, port, message)
         elif msg_type == "GET_BLOCK_REPLY":
             self.add_block(message)
+        elif msg_type == "GET_BLOCKS":
+            self.send_blocks_reply(host, port, message)
+        elif msg_type == "GET_BLOCKS_REPLY":
+            self.add_blocks(message)
         elif msg_type == "CONSENSUS":
             self.do_consensus()
         elif msg_type == "ANNOUNCE":
             self.add_to_verified_chain(message)
         else:
-            # print(f"--UNKNOWN--\n\t{addr}: {message}\n")
+            # print(f"--UNKNOWN--\n\t{host}:{port}: {message}\n")
             pass
 
     # GOSSIP ---------------------------------------------------------------------------------------------------------------
     def send_gossip(self):
-        """Send a simple gossip msg TO PROF PEERS"""
-        PROF_PEERS = [
-            ["silicon.cs.umanitoba.ca", 8999],
-            ["eagle.cs.umanitoba.ca", 8999],
-            ["hawk.cs.umanitoba.ca", 8999],
-            ["grebe.cs.umanitoba.ca", 8999],
-            ["goose.cs.umanitoba.ca", 8999]
-        ]
+        """Start a gossip round: a GOSSIP with a fresh id to `gossip_fanout` random peers"""
+        self.gossip_round += 1
         msg = {
             "type": "GOSSIP",
             "host": self.host,
             "port": self.port,
-            "id": self.gossip_id,
+            "id": f"{self.gossip_id}:{self.gossip_round}",
             "name": self.name
         }
-        # hardcoded to silicon
+        if self.binary_codec:
+            msg["codecs"] = [wire_codec.CODEC_NAME]
+        msg["features"] = ["GET_BLOCKS"]
+        self.seen_gossip.add(msg["id"])
         data = json.dumps(msg).encode('utf-8')
-        self.socket.sendto(data, (PROF_PEERS[0][0], PROF_PEERS[0][1]))
-        print(f"--GOSSIP_SENT--\n\tto {PROF_PEERS[0][0]}:{PROF_PEERS[0][1]}\n")
+        targets = self.gossip_targets()
+        sent = sum(self.send_quietly(data, host, port) for host, port in targets)
+        log.info("gossip sent", extra=fields(round=self.gossip_round, targets=len(targets), failed=len(targets) - sent))
+
+    def add_gossip(self, host, port, message):
+        """
+        First time we see a GOSSIP id: answer its origin, add it to our peers (it is alive and told us
+        where it listens) and forward the GOSSIP unchanged to `gossip_fanout` random peers.
+        Repeats (forwarded to us by someone else too) are dropped.
+        """
+        gossip_id = message.get("id")
+        if isinstance(gossip_id, str) and not self.seen_gossip.add(gossip_id):
+            return
+        origin_host, origin_port = message.get("host"), message.get("port")
+        if not isinstance(origin_host, str) or not isinstance(origin_port, int):
+            origin_host, origin_port = host, port
+        if (origin_host, origin_port) == (self.host, self.port):
+            return
+        self.send_gossip_reply(origin_host, origin_port)
+        self.add_gossiper(origin_host, origin_port, message)
+        if isinstance(gossip_id, str):
+            data = json.dumps(message).encode('utf-8')
+            for target_host, target_port in self.gossip_targets({f"{host}:{port}", f"{origin_host}:{origin_port}"}):
+                self.send_quietly(data, target_host, target_port)
+
+    def gossip_targets(self, exclude=()):
+        """(host, port) of `gossip_fanout` random known peers, topped up from the bootstrap peers"""
+        exclude = set(exclude)
+        exclude.add(f"{self.host}:{self.port}")
+        targets = [(gossiper["host"], gossiper["port"])
+                   for gossiper in self.received_gossipers.sample(self.gossip_fanout, exclude)]
+        if len(targets) < self.gossip_fanout:
+            for host, port in random.sample(self.bootstrap_peers, len(self.bootstrap_peers)):
+                if len(targets) == self.gossip_fanout:
+                    break
+                if f"{host}:{port}" not in exclude and (host, port) not in targets:
+                    targets.append((host, port))
+        return targets
 
     def send_gossip_reply(self, target_host, target_port):
         """Send a gossip reply to the FROM_PEER"""
@@ -144,80 +345,95 @@ class Peer:
             "port": self.port,
             "name": self.name
         }
+        if self.binary_codec:
+            msg["codecs"] = [wire_codec.CODEC_NAME]
+        msg["features"] = ["GET_BLOCKS"]
         data = json.dumps(msg).encode('utf-8')
-        self.socket.sendto(data, (target_host, target_port))
+        # the origin comes from the GOSSIP body, it may well not resolve
+        self.send_quietly(data, target_host, target_port)
         # print(f"--GOSSIP_REPLY_SENT--\n\tto {target_host}:{target_port}\n")
 
+    def capabilities(self, message):
+        """What the sender advertised that we use: our binary codec, GET_BLOCKS"""
+        features = set()
+        codecs = message.get("codecs")
+        if self.binary_codec and isinstance(codecs, list) and wire_codec.CODEC_NAME in codecs:
+            features.add(wire_codec.CODEC_NAME)
+        advertised = message.get("features")
+        if isinstance(advertised, list) and "GET_BLOCKS" in advertised:
+            features.add("GET_BLOCKS")
+        return frozenset(features)
+
+    def encode_for(self, msg, host, port):
+        """Binary for peers that advertised it, JSON for everyone else"""
+        return self.encode(msg, (host, port) in self.binary_peers)
+
+    def encode(self, msg, binary):
+        if binary:
+            data = wire_codec.encode(msg)
+            if data is not None:
+                return data
+        return json.dumps(msg).encode('utf-8')
+
     def add_gossiper(self, host, port, message):
-        """retain gossipers information"""
-        self.received_gossipers[f"{host}:{port}"] = {
-            "host": host,
-            "port": port,
-            "name": message.get("name", ""),
-            "kick_time": time.time() + 60
-        }
+        """retain gossipers information, with the capabilities they advertised"""
+        self.received_gossipers.refresh(host, port, message.get("name", ""), features=self.capabilities(message))
         # print(f"--ADDED_GOSSIPER--\n\t{host}:{port}\n")
 
     def kick_gossiper(self):
         """
-        Removes gossipers whose `kick_time` is greater than or equal to the current time.
+        Removes gossipers whose `kick_time` has passed, only the expired ones are looked at.
         """
-        curr_time = time.time()  # Get the current time
-        updated_gossipers = {}  # an empty dictionary to store valid gossipers
-        for host_port, data in self.received_gossipers.items():
-            if data["kick_time"] < curr_time:
-                updated_gossipers[host_port] = data  # Add it to the new dictionary
-        print(f"--KICKING--\n\t{len(updated_gossipers)}/{len(self.received_gossipers)} gossipers out!")
-        self.received_gossipers = updated_gossipers
+        total = len(self.received_gossipers)
+        kicked = self.received_gossipers.expire()
+        log.info("gossipers expired", extra=fields(kicked=kicked, total=total))
 
     ## debug method
     def check_gossipers(self):
-        if len(self.received_gossipers) != 0:
-            print(f"--MY_GOSSIPERS--\n\t{self.received_gossipers}")
-        else:
-            print(f"--MY_GOSSIPERS--\n\t NO ONE")
+        log.info("gossipers", extra=fields(known=len(self.received_gossipers)))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("gossiper table", extra=fields(table=repr(self.received_gossipers)))
 
     ## debug method
     # GOSSIP ---------------------------------------------------------------------------------------------------------------
 
     # STAT -----------------------------------------------------------------------------------------------------------------
     def send_stats(self, target_list):
-        """ Send stats message to list/dict of gossiped peers"""
-        if len(target_list) != 0:
-            for key, gossiper in target_list.items():
-                self.send_stat(gossiper['host'], gossiper['port'], gossiper['name'])
+        """Send stats message to the next `stats_fanout` gossipers of the PeerTable, round robin"""
+        for gossiper in target_list.next_batch(self.stats_fanout):
+            self.send_stat(gossiper['host'], gossiper['port'], gossiper['name'])
 
     def send_stat(self, target_host, target_port, target_name):
         """Send a stats msg to gossiped peer"""
         msg = {"type": "STATS"}
-        data = json.dumps(msg).encode('utf-8')
-        self.socket.sendto(data, (target_host, target_port))
+        data = self.encode_for(msg, target_host, target_port)
+        self.send_quietly(data, target_host, target_port)
         # print(f"--STATS_SENT--\n\tto {target_name} - {target_host}:{target_port}\n")
 
     def send_stat_reply(self, target_host, target_port):
         """Send a stat reply only if we have a verified chain"""
         if self.verified_chain_flag:
+            consensus_key = self.consensus_key
             msg = {
+                "type": "STATS_REPLY",
                 "host": self.host,
                 "port": self.port,
-                "height": self.consensus_key[0],
-                "hash": self.consensus_key[1]
+                "height": consensus_key[0],
+                "hash": consensus_key[1]
             }
-            data = json.dumps(msg).encode('utf-8')
-            self.socket.sendto(data, (target_host, target_port))
+            binary = (target_host, target_port) in self.binary_peers
+            data = self.reply_cache.stats_reply(consensus_key, binary, lambda: self.encode(msg, binary))
+            self.send_to(data, target_host, target_port)
             # print(f"--STATS_REPLY_SENT--\n\tto {target_host}:{target_port}\n")
 
     def add_stat(self, host, port, message):
         """Record stat details to perform consensus on"""
-        if stat_msg_valid(message):
+        if stat_msg_valid(message, self.difficulty):
             height = int(message.get("height", "0"))
             blk_hash = message.get("hash", "")
             the_key = (height, blk_hash)
-
-            if the_key not in self.received_stats:
-                # add host, port in a set to know who to contact upon consensus
-                self.received_stats[the_key] = set()
-            self.received_stats[the_key].add((host, port))
+            # add host, port in a set to know who to contact upon consensus, renews its expiry
+            self.received_stats.add(host, port, the_key)
             # print(f"--ADDED_STAT--\n\tfor {host}:{port}\n")
 
     ## debug method
@@ -234,29 +450,53 @@ class Peer:
 
     # CONSENSUS ------------------------------------------------------------------------------------------------------------
     def do_consensus(self):
-        """Perform consensus to choose chain with highest height"""
-        if self.currently_verifying_flag:
-            print("--UNABLE TO DO CONSENSUS AS CHAIN VERIFICATION IN PROCESS")
-        else:
-            print("--DOING_CONSENSUS--")
-            # avoid bad faulty consesnus
-            filtered_received_stats = [key for key in self.received_stats.keys() if key not in self.bad_consensus]
-            if filtered_received_stats:
-                # get highest
-                highest_height_last_hash_key = max(filtered_received_stats, key=lambda x: x[0])
-                print(f"\t--THE_CONSENSUS--\n\t\t{highest_height_last_hash_key}:{self.received_stats[highest_height_last_hash_key]}\n")
+        """
+        Perform consensus to choose chain with highest height.
+        Under the verify lock, a switch never lands in the middle of a verification pass on another thread;
+        `currently_verifying_flag` covers the async peer, whose check runs in the executor without the lock.
+        """
+        with self.verify_lock:
+            if self.currently_verifying_flag:
+                log.info("consensus skipped, verification in progress")
+                return
+            # get highest, avoiding bad faulty consesnus, most supporters wins a tie
+            highest_height_last_hash_key = self.received_stats.best(self.bad_consensus)
+            if highest_height_last_hash_key is not None:
+                log.info("consensus", extra=fields(height=highest_height_last_hash_key[0],
+                                                   hash=highest_height_last_hash_key[1],
+                                                   supporters=len(self.received_stats[highest_height_last_hash_key])))
                 # if we have a verified chain already
                 if self.verified_chain_flag:
                     # if height is greater than current consensus height > re-sync
                     if highest_height_last_hash_key[0] > self.consensus_key[0]:
-                        print("--RESYNC - CLEARING DICTIONARIES and CONSENSUS--")
-                        self.verified_chain_flag = False
-                        self.verified_blocks.clear()  # Clear all verified blocks
-                        self.block_tracker.clear()  # Clear all block tracking data
-                        self.consensus_key = highest_height_last_hash_key
-                        print("\tverified_blocks and block_tracker have been cleared.")
+                        self.start_resync(highest_height_last_hash_key)
+                elif highest_height_last_hash_key != self.consensus_key:
+                    self.start_resync(highest_height_last_hash_key)
+
+    def start_resync(self, new_key):
+        """
+        Switch to the `new_key` chain keeping our verified blocks as the prefix, only heights above it are fetched.
+        If the first new block doesn't link to our tip, `apply_verification` starts a fork search.
+        """
+        with self.verify_lock:
+            log.info("resync", extra=fields(height=new_key[0], hash=new_key[1], keeping=self.verified_tip))
+            self.verified_chain_flag = False
+            self.consensus_key = new_key
+            # its hosts are the ones we fetch from, keep them until the next resync
+            self.received_stats.pin(new_key)
+            self.block_tracker.clear()
+            self.failed_verifications.clear()
+            self.fork_finder = None
+            if self.verified_tip > new_key[0]:
+                # shorter than what we hold, its tip can only be at or below ours
+                self.truncate_chain(new_key[0])
+            self.resync_base = self.verified_tip
+            if self.verified_tip == new_key[0] and self.verified_tip > 0:
+                # nothing above our tip to link against, compare tips directly
+                if self.verified_blocks.hash_at(self.verified_tip - 1) == new_key[1]:
+                    self.verified_chain_flag = True
                 else:
-                    self.consensus_key = highest_height_last_hash_key
+                    self.start_fork_search()
     # CONSENSUS ------------------------------------------------------------------------------------------------------------
 
     # BLOCK ----------------------------------------------------------------------------------------------------------------
@@ -266,139 +506,385 @@ class Peer:
             "type": "GET_BLOCK",
             "height": block_height
         }
-        data = json.dumps(msg).encode('utf-8')
+        data = self.encode_for(msg, host, port)
         try:
-            self.socket.sendto(data, (host, port))
-            # adding heights to `set` to avoid dups
-            self.requested_block_heights.add(block_height)
+            self.send_to(data, host, port)
             # print(f"\t--GET_BLOCK_SENT--\n\t\tfor the height {block_height}\n\tto {host}:{port}\n")
         except Exception as e:
-            print(f"--ERROR_GET_BLOCK_REQ--\n\t{e}")
+            log.warning("get block failed", extra=fields(host=host, port=port, error=e))
 
     def send_get_blocks(self):
-        """Send get blocks for all in height range to all stat hosts,ports"""
+        """Hand out missing heights to the consensus hosts, a bounded window per host"""
         if self.consensus_key != (-1, ""):
-            consensus_height = self.consensus_key[0]
-            host_port_set = self.received_stats[self.consensus_key]
-            for block_height in range(consensus_height):
-                # if key not in verified_blocks
-                if block_height not in self.verified_blocks:
-                    for host, port in host_port_set:
-                        self.send_get_block(host, port, block_height)
+            # the handler thread (add_block) and the event thread (the tick) both get here
+            with self.downloader.lock:
+                if self.download_key != self.consensus_key:
+                    # new chain to sync, anything in flight was for the old one, our verified prefix is kept
+                    self.downloader.reset(self.verified_tip)
+                    self.download_key = self.consensus_key
+                self.downloader.set_target(self.consensus_key[0], self.verified_blocks)
+                host_port_set = self.received_stats.get(self.consensus_key, ())
+                # looked up once, a GOSSIP on another thread can change a host's capabilities mid-schedule
+                range_peers = {peer for peer in host_port_set if peer in self.range_peers}
+                assigned = self.downloader.schedule(host_port_set, range_peers=range_peers)
+            with self.verify_lock:
+                if self.fork_finder is not None:
+                    self.send_fork_probe(host_port_set)
+            # consecutive heights for the same GET_BLOCKS host go out as one GET_BLOCKS, at most a run long (what
+            # is served), everyone else only understands GET_BLOCK
+            index = 0
+            while index < len(assigned):
+                block_height, (host, port) = assigned[index]
+                count = 1
+                while ((host, port) in range_peers and index + count < len(assigned)
+                       and count < self.downloader.range_chunk
+                       and assigned[index + count][1] == (host, port)
+                       and assigned[index + count][0] == block_height + count):
+                    count += 1
+                if count > 1:
+                    self.send_get_block_range(host, port, block_height, count)
+                else:
+                    self.send_get_block(host, port, block_height)
+                index += count
+
+    def send_get_block_range(self, host, port, block_height, count):
+        """Ask a GET_BLOCKS capable host for `count` blocks from `block_height` up"""
+        msg = {
+            "type": "GET_BLOCKS",
+            "height": block_height,
+            "count": count
+        }
+        data = self.encode_for(msg, host, port)
+        try:
+            self.send_to(data, host, port)
+        except Exception as e:
+            log.warning("get blocks failed", extra=fields(host=host, port=port, error=e))
+
+    def start_fork_search(self):
+        """Our tip doesn't link to the new consensus chain, look for the highest height both agree on"""
+        if self.fork_finder is None:
+            log.info("fork search", extra=fields(below=self.verified_tip))
+            self.fork_finder = ForkFinder(self.verified_tip)
+            self.send_fork_probe(self.received_stats.get(self.consensus_key, ()))
+
+    def send_fork_probe(self, host_port_set):
+        """(Re)send the current fork probe, a different consensus host on every timeout"""
+        if self.fork_finder.due() and host_port_set:
+            block_height = self.fork_finder.probe
+            if block_height is None:
+                block_height = self.fork_finder.next_probe()
+            hosts = sorted(host_port_set)
+            host, port = hosts[self.fork_finder.probes_sent % len(hosts)]
+            self.fork_finder.sent()
+            self.send_get_block(host, port, block_height)
+
+    def add_fork_probe(self, message):
+        """Compare the new chain's block with ours, once settled keep the common prefix and fetch the rest"""
+        height_key = message["height"]
+        with self.verify_lock:
+            # a consensus on another thread may have called the search off since add_block looked
+            if self.fork_finder is None or height_key >= self.verified_tip:
+                return
+            matches = self.verified_blocks.hash_at(height_key) == message["hash"]
+            if not self.fork_finder.on_block(height_key, matches):
+                return
+            if not self.fork_finder.done():
+                self.send_fork_probe(self.received_stats.get(self.consensus_key, ()))
+                return
+            fork_height = self.fork_finder.fork_height()
+            old_tip = self.verified_tip
+            log.info("fork found", extra=fields(keeping=fork_height, refetching=old_tip - fork_height))
+            self.fork_finder = None
+            self.truncate_chain(fork_height)
+            # the chains agree below the fork, a block failing there from now on is just a bad block
+            self.resync_base = 0
+            # heights from the fork point up to the old tip are wanted again
+            self.downloader.want(range(fork_height, old_tip + 1))
+        self.send_get_blocks()
+        self.verify_from_tip()
 
     def add_block(self, message):
-        """Record multiple block json details according to block height"""
+        """Record multiple block json details according to block height, verifying as soon as the tip is filled"""
+        if not block_msg_valid(message, self.difficulty):
+            return
         height_key = message["height"]
-        if height_key not in self.block_tracker and height_key in range(0, self.consensus_key[0]):
-            self.block_tracker[height_key] = set()
-        # json need to be serialized to add to set
-        self.block_tracker[height_key].add(json.dumps(message, sort_keys=True))
-        # print(f"--ADDED_BLOCK--: {height_key}")
+        if height_key < self.verified_tip:
+            # below the tip is already verified, only a fork probe answer is of interest
+            if self.fork_finder is not None:
+                self.add_fork_probe(message)
+            return
+        if height_key < self.consensus_key[0]:
+            # parsed once, a resent block is dropped here by its hash
+            added = self.block_tracker.add(Block.from_message(message))
+            if added == REJECTED:
+                self.add_rejected_block(height_key)
+                return
+            if added != ADDED:
+                return
+            self.metrics.inc("blocks_received_total")
+            # print(f"--ADDED_BLOCK--: {height_key}")
+            # a usable candidate is in, stop asking for this height and refill the freed slot
+            if self.download_key == self.consensus_key:
+                self.downloader.complete(height_key)
+                self.send_get_blocks()
+            # it extends the verified prefix, verify it and whatever was waiting behind it
+            # with a parallel verifier the verify tick batches it up instead of hashing on the receive thread
+            if height_key == self.verified_tip and self.verifier is None:
+                self.verify_from_tip()
+
+    def add_rejected_block(self, height_key):
+        """
+        A block that already failed verification answered our request for `height_key`. Its sender serves the same
+        bad chain as the first one, so it counts as another failure there, the same as if it had been hashed again.
+        """
+        if self.download_key == self.consensus_key and self.downloader.complete(height_key):
+            with self.verify_lock:
+                if height_key >= self.verified_tip and height_key < self.consensus_key[0]:
+                    self.verify_passes["failed"] += 1
+                    self.count_failure(height_key)
 
     def send_block_reply(self, target_host, target_port, message):
         """Send a block reply only if we have a verified chain"""
         if self.verified_chain_flag:
             the_height = message["height"]
             if the_height in range(0, self.consensus_key[0]):
-                msg = self.verified_blocks[message["height"]]
-                data = json.dumps(msg).encode('utf-8')
-                self.socket.sendto(data, (target_host, target_port))
+                data = self.block_reply_at(the_height, (target_host, target_port) in self.binary_peers)
+                self.send_to(data, target_host, target_port)
+
+    def send_blocks_reply(self, target_host, target_port, message):
+        """
+        Serve a GET_BLOCKS range from verified_blocks, as many blocks per datagram as fit under the MTU.
+        Only to gossipers we know, a UDP source is easily spoofed and the reply is far bigger than the request.
+        """
+        if self.verified_chain_flag and f"{target_host}:{target_port}" in self.received_gossipers:
+            start = message.get("height")
+            count = message.get("count")
+            if not isinstance(start, int) or not isinstance(count, int) or start < 0:
+                return
+            end = min(start + min(count, MAX_BLOCKS_PER_REQUEST), self.consensus_key[0], len(self.verified_blocks))
+            for data in self.pack_blocks(range(start, end), target_host, target_port):
+                self.send_to(data, target_host, target_port)
+
+    def pack_blocks(self, heights, host, port):
+        """
+        GET_BLOCKS_REPLY datagrams for the verified blocks at `heights`, a block too big for the MTU still goes alone.
+        Built from the GET_BLOCK_REPLY of each block, a binary one minus its header is the block body.
+        """
+        if (host, port) in self.binary_peers:
+            replies = [self.block_reply_at(height, True) for height in heights]
+            if all(wire_codec.is_binary(data) for data in replies):
+                bodies = [data[wire_codec.HEADER.size:] for data in replies]
+                return [wire_codec.pack_blocks_reply(chunk)
+                        for chunk in chunk_by_size(bodies, self.mtu - wire_codec.blocks_reply_size([]),
+                                                   per_item=2, max_items=255)]
+        prefix = b'{"type": "GET_BLOCKS_REPLY", "blocks": ['
+        suffix = b']}'
+        parts = [self.block_reply_at(height, False) for height in heights]
+        return [prefix + b", ".join(chunk) + suffix
+                for chunk in chunk_by_size(parts, self.mtu - len(prefix) - len(suffix), per_item=2)]
+
+    def block_reply(self, block, binary):
+        """Encoded GET_BLOCK_REPLY of a verified block, encoded once and then served from the reply cache"""
+        return self.reply_cache.block_reply(block, binary, lambda msg: self.encode(msg, binary))
+
+    def block_reply_at(self, height, binary):
+        """
+        GET_BLOCK_REPLY of the verified block at `height`. A cold block's reply, JSON or binary, is a view into the
+        segment sent without a copy; cold blocks are not put in the reply cache so it only ever holds the hot tail.
+        """
+        raw = self.verified_blocks.raw(height, binary)
+        if raw is None:
+            return self.block_reply(self.verified_blocks[height], binary)
+        return raw
+
+    def add_blocks(self, message):
+        """Split a GET_BLOCKS_REPLY into add_block calls"""
+        blocks = message.get("blocks")
+        if isinstance(blocks, list):
+            for block in blocks:
+                if isinstance(block, dict):
+                    self.add_block(block)
+
+    ## debug method
+    def check_admission(self):
+        log.info("admission", extra=fields(**self.admission.counters()))
+
+    ## debug method
+    def check_reply_cache(self):
+        log.info("reply cache", extra=fields(**self.reply_cache.counters()))
 
     ## debug method
     def check_block_tracker(self):
-        if len(self.block_tracker) != 0:
-            print(f"--MY_BLOCK_TRACKER--\n\t{self.block_tracker}")
-        else:
-            print(f"--MY_BLOCK_TRACKER--\n\t NONE")
+        log.info("block tracker", extra=fields(heights=len(self.block_tracker)))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("block tracker table", extra=fields(table=repr(self.block_tracker)))
     ## debug method
 
     def verify_block_chain(self):
         """
-        Verifies blocks up to the consensus height. If a block fails verification,
-        consensus is re-initiated, and dictionaries are cleared to start over.
+        Periodic catch-up and progress line, blocks are normally verified by `add_block` as they arrive.
+        If a block fails verification, consensus is re-initiated, and dictionaries are cleared to start over.
         """
-        good_consensus = True  # Flag to track if the consensus remains valid
-        print("--VERIFY_BLOCKS--")
-
-        # If verification is not yet complete (verified blocks don't match the consensus height)
-        if self.consensus_key != -1 and (self.consensus_key[0] != len(self.verified_blocks)):
-            # Check if we have all the blocks required for verification
-            if len(self.block_tracker) == self.consensus_key[0]:
-                # we have now entered verification. No consensus allowed
-                self.currently_verifying_flag = True
-                # Iterate over block heights in order
-                for height_key, set_of_block_serialized_jsons in sorted(self.block_tracker.items()):
-                    # Stop verification if the consensus is already marked bad
-                    if not good_consensus:
-                        print("\tConsensus marked as bad. Stopping verification.")
-                        break
-
-                    # If the current block height hasn't been verified yet
-                    if height_key not in self.verified_blocks:
-                        print(f"\tVERIFYING: {height_key}")
-
-                        # Determine the previous hash
-                        prev_hash = "" if height_key == 0 else self.verified_blocks.get(height_key - 1, {}).get("hash","")
-
-                        # Ensure we have a valid previous hash
-                        if (height_key == 0 and prev_hash == "") or (height_key > 0 and prev_hash):
-                            # Loop through candidate blocks at this height
-                            for serialized_json_block in set_of_block_serialized_jsons:
-                                # Deserialize the current block
-                                json_block = json.loads(serialized_json_block)
-
-                                # Attempt to verify the block
-                                if verification(prev_hash, json_block, 8):
-                                    # If verified, add to verified blocks
-                                    self.verified_blocks[height_key] = json_block
-                                    print(f"\t\tADDED_TO_VERIFIED: {self.verified_blocks[height_key].get('height')}")
-                                    # if complete chain verified
-                                    if height_key == self.consensus_key[0] - 1:
-                                        self.verified_chain_flag = True
-                                        self.currently_verifying_flag = False
-                                        print("\t\t\t--VERIFICATION COMPLETE--\n\n")
-                                    break
-                                else:
-                                    # If block fails verification, mark consensus as bad and stop verification
-                                    print(f"\tNOT ADDED_TO_VERIFIED")
-                                    self.bad_consensus.append(self.consensus_key)
-                                    self.currently_verifying_flag = False
-                                    good_consensus = False
-                                    break
-                        else:
-                            # Missing previous hash; cannot proceed
-                            print(f"\tMISSING PREV_HASH FOR {height_key}. Stopping verification.")
-                            self.currently_verifying_flag = False
-                            break
-                    else:
-                        # Block is already verified; skip it
-                        print(f"\tALREADY_VERIFIED: {self.verified_blocks[height_key].get('height')}")
-            else:
-                # Not all blocks are present in the tracker; cannot verify
-                self.currently_verifying_flag = False
-                print("--BLOCKS AVAILABLE--")
-                print(f"\t{len(self.block_tracker)}/{self.consensus_key[0]}")
-        else:
-            # Verification already completed
+        self.verify_from_tip()
+        with self.verify_lock:
+            self.persist_verified()
+        self.log_verify_summary()
+
+    def log_verify_summary(self):
+        """One line per tick for every verification pass since the last one, however long the chain"""
+        passes, self.verify_passes = self.verify_passes, {"passes": 0, "blocks": 0, "failed": 0}
+        log.info("verify", extra=fields(tip=self.verified_tip, consensus=self.consensus_key[0],
+                                        waiting=len(self.block_tracker), **passes))
+
+    def verify_from_tip(self):
+        """Verify the contiguous run of received blocks right after the verified tip"""
+        with self.verify_lock:
+            pending = self.pending_verification()
+            if pending is not None:
+                prev_hash, run = pending
+                self.apply_verification(pending, *self.check_run(prev_hash, run))
+
+    def check_run(self, prev_hash, run):
+        """`check_chain`, or the parallel verifier for runs long enough to pay for the pool"""
+        anchors = self.checkpoints.covering(run)
+        if self.verifier is not None and len(run) >= self.verifier.batch_size:
+            return self.verifier.verify_run(prev_hash, run, self.block_tracker.known_good(run), anchors)
+        return check_chain(prev_hash, run, self.difficulty, self.block_tracker.verified, self.observe_verification,
+                           anchors)
+
+    def observe_verification(self, seconds):
+        self.metrics.observe("verification_seconds", seconds)
+
+    def pending_verification(self, limit=None):
+        """
+        Snapshot of what can be verified now as (prev_hash, [(height, [candidate_json, ...]), ...]),
+        or None when the block right after the tip hasn't arrived. Only reads state, so the check
+        itself can run elsewhere. `limit` caps the run, the rest is left for the next pass.
+        """
+        if self.consensus_key == (-1, "") or self.fork_finder is not None:
+            return None
+        run = []
+        height_key = self.verified_tip
+        end = self.consensus_key[0] if limit is None else min(self.consensus_key[0], height_key + limit)
+        while height_key < end and height_key in self.block_tracker:
+            run.append((height_key, self.block_tracker.candidates(height_key)))
+            height_key += 1
+        if not run:
+            return None
+        # Determine the previous hash
+        prev_hash = "" if self.verified_tip == 0 else self.verified_blocks.hash_at(self.verified_tip - 1)
+        # we have now entered verification. No consensus allowed
+        self.currently_verifying_flag = True
+        return prev_hash, run
+
+    def apply_verification(self, pending, verified, bad_height):
+        """Record the outcome of `check_chain` for a snapshot from `pending_verification`"""
+        prev_hash, run = pending
+        self.currently_verifying_flag = False
+        # state may have moved on while the check ran elsewhere (resync, announce)
+        if run[0][0] != self.verified_tip or self.fork_finder is not None:
+            return
+        for block in verified:
+            # If verified, add to verified blocks, candidates for the height are no longer needed
+            height_key = block.height
+            json_block = block.to_message()
+            self.verified_blocks[height_key] = json_block
+            self.unsaved_blocks.append(json_block)
+            self.block_tracker.mark_verified(prev_hash, block)
+            self.block_tracker.pop(height_key, None)
+            self.failed_verifications.pop(height_key, None)
+            self.downloader.forget(height_key)
+            prev_hash = block.hash
+        self.verified_tip += len(verified)
+        self.metrics.inc("blocks_verified_total", amount=len(verified))
+        self.verify_passes["passes"] += 1
+        self.verify_passes["blocks"] += len(verified)
+        # if complete chain verified
+        if verified and self.verified_tip == self.consensus_key[0]:
             self.verified_chain_flag = True
-            print("--VERIFICATION COMPLETE--\n\n")
-            self.currently_verifying_flag = False
-
-        # Clear dictionaries if consensus is bad
-        if not good_consensus:
-            print("--RESYNC - CLEARING DICTIONARIES and CONSENSUS--")
-            self.consensus_key = (-1, "")
-            self.verified_blocks.clear()  # Clear all verified blocks
-            self.block_tracker.clear()  # Clear all block tracking data
-            print("\tverified_blocks and block_tracker have been cleared.")
-            self.do_consensus()
+            self.resync_base = 0
+            self.persist_verified()
+            log.info("verification complete", extra=fields(height=self.verified_tip))
+        elif len(self.unsaved_blocks) >= 500:
+            self.persist_verified()
+
+        if bad_height is not None:
+            # every candidate we hold for the height failed, throw them away and ask someone else
+            self.verify_passes["failed"] += 1
+            log.warning("no valid block", extra=fields(height=bad_height))
+            if bad_height == self.resync_base and bad_height > 0:
+                # the new chain may not build on the prefix we kept, find out where it leaves it
+                # its blocks may well be fine on top of the fork point, so they are not rejected
+                self.block_tracker.pop(bad_height, None)
+                self.start_fork_search()
+                return
+            self.block_tracker.reject(bad_height)
+            self.count_failure(bad_height)
+
+    def count_failure(self, height_key):
+        """One more consensus host handed us a bad block at `height_key`, ask the next one or give up on the consensus"""
+        failures = self.failed_verifications.get(height_key, 0) + 1
+        self.failed_verifications[height_key] = failures
+        if failures < max(1, len(self.received_stats.get(self.consensus_key, ()))):
+            self.downloader.retry(height_key)
+            return
+        # every consensus host handed us a bad block, mark consensus as bad
+        # the blocks verified below it are valid and stay as the prefix for the next consensus
+        self.bad_consensus.add(self.consensus_key)
+        log.warning("bad consensus", extra=fields(height=self.consensus_key[0], hash=self.consensus_key[1],
+                                                  keeping=self.verified_tip))
+        self.consensus_key = (-1, "")
+        self.block_tracker.clear()
+        self.failed_verifications.clear()
+        self.do_consensus()
+
+    def truncate_chain(self, height_key):
+        """Drop verified blocks at `height_key` and above, costs the number of blocks dropped"""
+        self.verified_blocks.truncate(height_key)
+        self.reply_cache.truncate(height_key)
+        self.unsaved_blocks = [json_block for json_block in self.unsaved_blocks if json_block["height"] < height_key]
+        if self.db is not None and height_key < self.verified_tip:
+            self.db.delete_from(height_key)
+        if height_key < self.verified_tip:
+            # rejections were judged against the prefix we just cut
+            self.block_tracker.forget_rejected()
+        self.verified_tip = min(self.verified_tip, height_key)
+        self.verified_chain_flag = False
+
+    def attach_db(self, db):
+        """Persist the verified chain to `db` and warm start from whatever it already holds"""
+        self.db = db
+        with self.verify_lock:
+            # streamed straight into the tiers, the whole chain is never held as dicts
+            for height_key, block in db.iter_chain():
+                self.verified_blocks[height_key] = block
+            stored = len(self.verified_blocks)
+            if stored:
+                self.verified_tip = stored
+                self.consensus_key = (self.verified_tip, self.verified_blocks.hash_at(self.verified_tip - 1))
+                self.verified_chain_flag = True
+        if stored:
+            log.info("loaded chain", extra=fields(blocks=self.verified_tip, tip=self.consensus_key[1]))
+
+    def persist_verified(self):
+        """Write the verified blocks not stored yet in one transaction"""
+        if self.db is not None and self.unsaved_blocks:
+            # a resync may have rewritten heights we have not flushed yet, newest wins
+            self.db.add_blocks(self.unsaved_blocks)
+        self.unsaved_blocks = []
+
+    def export_checkpoints(self, path, interval=CHECKPOINT_INTERVAL):
+        """Save anchors of our verified chain to `path` for `Checkpoints.load`"""
+        with self.verify_lock:
+            checkpoints = Checkpoints.from_chain(self.verified_blocks, self.verified_tip, interval)
+        checkpoints.save(path)
+        return checkpoints
 
     ## debug method
     def check_verified_blocks(self):
-        if len(self.verified_blocks) != 0:
-            print(f"--MY_BLOCK_CHAIN--\n\t{self.verified_blocks}")
-        else:
-            print(f"--MY_BLOCK_CHAIN--\n\t NONE")
+        log.info("verified chain", extra=fields(blocks=len(self.verified_blocks)))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("verified chain table", extra=fields(table=repr(self.verified_blocks)))
     ## debug method
 
 # BLOCK ----------------------------------------------------------------------------------------------------------------
@@ -407,19 +893,172 @@ class Peer:
     def add_to_verified_chain(self, message):
         if self.verified_chain_flag:
             if message["height"] == self.consensus_key[0]:
-                if verification(self.consensus_key[1], message, 8):
+                start = time.perf_counter()
+                valid = verification(self.consensus_key[1], message, self.difficulty)
+                self.observe_verification(time.perf_counter() - start)
+                if valid:
                     # keep format consistent
                     message["type"] = "GET_BLOCK_REPLY"
-                    self.verified_blocks[message["height"]] = message
-                    print(f"--ANNOUNCEMENT_ADDED--: {message['height']}")
+                    with self.verify_lock:
+                        self.verified_blocks[message["height"]] = message
+                        self.verified_tip = message["height"] + 1
+                        self.unsaved_blocks.append(message)
+                        self.persist_verified()
+                        # our chain is one longer now
+                        self.consensus_key = (self.verified_tip, message["hash"])
+                    log.info("announcement added", extra=fields(height=message["height"]))
                 else:
-                    print("--BAD ANNOUNCEMENT--")
+                    log.warning("bad announcement", extra=fields(height=message["height"]))
         else:
-            print("Unable to add ANNOUNCEMET as my chain is incomplete")
+            log.info("announcement ignored, chain incomplete", extra=fields(height=message.get("height")))
+
+    def send_announce(self, block):
+        """Tell every gossiper about a block we mined"""
+        msg = dict(block, type="ANNOUNCE")
+        for gossiper in list(self.received_gossipers.values()):
+            data = self.encode_for(msg, gossiper["host"], gossiper["port"])
+            self.send_quietly(data, gossiper["host"], gossiper["port"])
 # ANNOUNCE -------------------------------------------------------------------------------------------------------------
 
+# MINE -----------------------------------------------------------------------------------------------------------------
+    def mining_target(self):
+        """(height, prev_hash) of the next block on our chain, None until we have a complete chain"""
+        if self.verified_chain_flag and self.consensus_key[0] > 0:
+            return self.consensus_key
+        return None
+
+    def mine_next(self):
+        """Mine one block on our tip, given up as soon as the tip moves (resync, someone else's ANNOUNCE)"""
+        target = self.mining_target()
+        if target is None:
+            return None
+        return self.miner.mine(target[1], target[0], self.mine_messages, self.name,
+                               should_stop=lambda: self.consensus_key != target)
+
+    def add_mined_block(self, block):
+        """Append a block from `mine_next` to our verified chain and ANNOUNCE it, ignored if it went stale"""
+        target = self.mining_target()
+        if block is None or target is None or block["height"] != target[0]:
+            return
+        self.add_to_verified_chain(block)
+        if self.verified_blocks.get(block["height"]) is block:
+            log.info("mined", extra=fields(height=block["height"], hash=block["hash"],
+                                           hash_rate=round(self.miner.last_rate)))
+            self.send_announce(block)
+
+    def mine_forever(self):
+        """Threaded runtime: keep extending our chain, idles while it is incomplete"""
+        while True:
+            block = self.mine_next()
+            if block is None:
+                time.sleep(1)
+            else:
+                self.add_mined_block(block)
+# MINE -----------------------------------------------------------------------------------------------------------------
+
+# METRICS --------------------------------------------------------------------------------------------------------------
+    def describe_metrics(self):
+        metrics = self.metrics
+        metrics.describe("messages_received_total", "counter", "Validated msgs run by a handler", "type")
+        metrics.describe("handler_seconds", "histogram", "Time spent in the handler of a msg", "type")
+        metrics.describe("handler_errors_total", "counter", "Handlers that raised", "type")
+        metrics.describe("verification_seconds", "histogram", "Time of one block verification")
+        metrics.describe("blocks_received_total", "counter", "New block candidates received for download")
+        metrics.describe("blocks_verified_total", "counter", "Blocks verified and added to the chain")
+        metrics.describe("malformed_total", "counter", "Datagrams that failed to decode or validate")
+        metrics.describe("socket_errors_total", "counter", "Errors from the UDP socket", "op")
+        metrics.collector(self.collect_metrics)
+
+    def collect_metrics(self):
+        """Gauges read on export: sync progress, queues and caches"""
+        progress = self.downloader.progress()
+        admission = self.admission.counters()
+        reply_cache = self.reply_cache.counters()
+        gauges = [
+            ("verified_height", "gauge", "Blocks in our verified chain", None, {None: self.verified_tip}),
+            ("consensus_height", "gauge", "Height of the chain we sync towards", None, {None: self.consensus_key[0]}),
+            ("heights_waiting", "gauge", "Heights with unverified candidates", None, {None: len(self.block_tracker)}),
+            ("download_in_flight", "gauge", "Block requests waiting for an answer", None,
+             {None: progress["in_flight"]}),
+            ("download_queued", "gauge", "Heights waiting to be requested", None, {None: progress["queued"]}),
+            ("download_requests_total", "counter", "Block requests sent", None, {None: progress["requests_sent"]}),
+            ("download_timeouts_total", "counter", "Block requests that timed out", None,
+             {None: progress["timeouts"]}),
+            ("download_retries_total", "counter", "Heights requested again", None, {None: progress["retries"]}),
+            ("admission_queued", "gauge", "Admitted msgs waiting for a handler", None, {None: admission["queued"]}),
+            ("admission_dropped_total", "counter", "Msgs dropped over their source's budget", "type",
+             admission["dropped"]),
+            ("admission_shed_total", "counter", "Msgs shed from a full queue", "type", admission["shed"]),
+            ("reply_cache_hits_total", "counter", "Block replies served from the cache", None,
+             {None: reply_cache["hits"]}),
+            ("reply_cache_misses_total", "counter", "Block replies encoded on demand", None,
+             {None: reply_cache["misses"]}),
+            ("known_peers", "gauge", "Gossipers in the peer table", None, {None: len(self.received_gossipers)}),
+        ]
+        drops = udp_drops(self.socket.getsockname()[1])
+        if drops is not None:
+            gauges.append(("socket_kernel_drops_total", "counter", "Datagrams the kernel dropped on our socket",
+                           None, {None: drops}))
+        return gauges
+
+    def write_metrics(self):
+        if self.metrics_file:
+            self.metrics.write(self.metrics_file)
+# METRICS --------------------------------------------------------------------------------------------------------------
+
 
 # UTIL ----------------------------------------------------------------------------------------------------------------
+def make_socket(host, port, reuse_port=False):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_RCVBUF)
+    except OSError:
+        # capped by the OS (net.core.rmem_max), the default still works
+        pass
+    if reuse_port:
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise OSError("SO_REUSEPORT is not supported on this platform")
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    return sock
+
+def recv_batch(sock, max_batch=RECV_BATCH):
+    """Block for one datagram, then drain whatever else is already queued without blocking"""
+    batch = [sock.recvfrom(RECV_BUFFER_SIZE)]
+    dont_wait = getattr(socket, "MSG_DONTWAIT", 0)
+    while dont_wait and len(batch) < max_batch:
+        try:
+            batch.append(sock.recvfrom(RECV_BUFFER_SIZE, dont_wait))
+        except (BlockingIOError, InterruptedError):
+            break
+    return batch
+
+def chunk_by_size(parts, budget, per_item=0, max_items=None):
+    """Group byte strings in order so each group's size (+ `per_item` each) stays within `budget`"""
+    chunk = []
+    size = 0
+    for part in parts:
+        cost = len(part) + per_item
+        if chunk and (size + cost > budget or len(chunk) == max_items):
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append(part)
+        size += cost
+    if chunk:
+        yield chunk
+
+def type_label(msg_type):
+    """Metric label of a msg type"""
+    return msg_type if msg_type in HANDLED_TYPES else "other"
+
+
+def decode_datagram(data):
+    """Bytes off the wire to a msg dict, JSON or the binary codec"""
+    if wire_codec.is_binary(data):
+        return wire_codec.decode(data)
+    return json.loads(data.decode('utf-8'))
+
 def validate_msg(addr, msg):
     try:
         # Validate address
@@ -441,29 +1080,90 @@ def validate_msg(addr, msg):
         return host, port, msg_type, msg
 
     except ValueError as e:
-        print(f"Validation Error: {e}")
+        log.debug("invalid msg", extra=fields(host=addr[0], port=addr[1], error=e))
         raise
 
-def stat_msg_valid(msg):
+def block_msg_valid(msg, difficulty=DIFFICULTY):
+    """Shape check for a block reply, so junk never reaches block_tracker or the downloader"""
+    try:
+        if not isinstance(msg["height"], int) or msg["height"] < 0:
+            return False
+        if not isinstance(msg["hash"], str) or not msg["hash"].endswith("0" * difficulty):
+            return False
+        if not isinstance(msg["messages"], list) or not isinstance(msg["minedBy"], str):
+            return False
+        if not all(isinstance(message, str) for message in msg["messages"]):
+            return False
+        return isinstance(msg["nonce"], str) and isinstance(msg["timestamp"], int)
+    except (KeyError, TypeError):
+        return False
+
+def stat_msg_valid(msg, difficulty=DIFFICULTY):
     try:
         if "height" not in msg or "hash" not in msg:
             return False
-        # Validate hash: it must be a non-empty string, reasonably long and has 8 0s at minimum
-        if not isinstance(msg["hash"], str) or len(msg["hash"]) < 10 or msg["hash"][-8:] != "0" * 8:
+        # Validate hash: it must be a non-empty string, reasonably long and has `difficulty` 0s at minimum
+        if not isinstance(msg["hash"], str) or len(msg["hash"]) < 10 or not msg["hash"].endswith("0" * difficulty):
             return False
         int(msg["height"])
         return True
     except (ValueError, TypeError):
         return False
 
+def check_chain(prev_hash, run, difficulty=8, known_good=None, observe=None, anchors=None):
+    """
+    Walk `run` = [(height, [Block, ...]), ...] in order, keeping the first candidate
+    at each height that verifies against the block before it.
+    known_good: (hash, fingerprint) -> prev_hash of blocks that already passed, they are not hashed again
+    observe: optional callback given the seconds each `verification` call took
+    anchors: height -> trusted hash from `Checkpoints.covering`, a candidate with another hash there fails unhashed
+    Pure function so it can be shipped to an executor.
+    returns ([verified Block, ...], first bad height or None)
+    """
+    verified = []
+    known_good = known_good or {}
+    anchors = anchors or {}
+    for height_key, candidates in run:
+        # Loop through candidate blocks at this height
+        for block in candidates:
+            if off_anchor(anchors, height_key, block):
+                valid = False
+            elif known_good.get((block.hash, block.fingerprint)) == prev_hash:
+                valid = True
+            elif observe is None:
+                valid = verification(prev_hash, block, difficulty)
+            else:
+                start = time.perf_counter()
+                valid = verification(prev_hash, block, difficulty)
+                observe(time.perf_counter() - start)
+            if valid:
+                verified.append(block)
+                prev_hash = block.hash
+                break
+        else:
+            return verified, height_key
+    return verified, None
+
+def off_anchor(anchors, height_key, block):
+    """
+    True if `height_key` is anchored to another hash than `block` claims, so the chain can't fork below the top
+    checkpoint. A block matching its anchor is still hashed: the anchor vouches for a hash, only hashing binds the
+    block's content to it.
+    """
+    anchor = anchors.get(height_key)
+    return anchor is not None and block.hash != anchor
+
+
 def verification(previous_hash, current_block_json, difficulty=8):
     try:
         if len(current_block_json['nonce']) > 40:
-            print("Nonce is > 40 char")
+            verify_log.info("rejected", extra=fields(height=current_block_json.get('height'),
+                                                     reason="nonce > 40 chars"))
             return False
 
         if not (1 <= len(current_block_json['messages']) <= 10):
-            print("Messages not in range [1,10]")
+            verify_log.info("rejected", extra=fields(height=current_block_json.get('height'),
+                                                     reason="messages not in [1, 10]"))
             return False
 
         hashBase = hashlib.sha256()
@@ -471,7 +1171,8 @@ def verification(previous_hash, current_block_json, difficulty=8):
         hashBase.update(current_block_json['minedBy'].encode())
         for message in current_block_json['messages']:
             if len(message) > 20:
-                print("Message is > 20 char")
+                verify_log.info("rejected", extra=fields(height=current_block_json.get('height'),
+                                                         reason="message > 20 chars"))
                 return False
             hashBase.update(message.encode())
         hashBase.update(current_block_json['timestamp'].to_bytes(8, 'big'))
@@ -479,18 +1180,20 @@ def verification(previous_hash, current_block_json, difficulty=8):
         calculated_hash = hashBase.hexdigest()
         # print(f"MATCHING: {calculated_hash} ? {current_block_json['hash']}")
         if calculated_hash[-difficulty:] != '0' * difficulty:
-            print(f"--DIFFICULY_NO_GOOD--\n\t{calculated_hash}")
+            verify_log.info("rejected", extra=fields(height=current_block_json.get('height'), reason="difficulty",
+                                                     hash=calculated_hash))
             return False
         if calculated_hash != current_block_json['hash']:
-            print(f"--HASH_NO_MATCH--\n\t{calculated_hash} != {current_block_json['hash']}")
+            verify_log.info("rejected", extra=fields(height=current_block_json.get('height'), reason="hash mismatch",
+                                                     hash=calculated_hash, claimed=current_block_json['hash']))
             return False
 
         # print(f"\t--YOUVE BEEN VERIFIED--\n\t\t{calculated_hash}")
         return True
 
     except KeyError as e:
-        print(f"Missing key in current_block: {e}")
+        verify_log.info("rejected", extra=fields(reason="missing key", key=e))
         return False
     except Exception as ex:
-        print(f"Error during block verification: {ex}")
+        verify_log.info("rejected", extra=fields(reason="error", error=ex))
         return False
@@ -0,0 +1,127 @@
+"""
+Logging for the peer: levelled, structured records written by a background thread.
+    log = get_logger("peer")
+    log.info("gossip sent", extra=fields(targets=3))
+Every record goes through a bounded queue to a `QueueListener` thread, so the calling thread never waits
+on stdout or a file; when the queue is full the record is dropped and counted instead. Each (logger, event)
+pair has its own token bucket, so a message repeated per block or per datagram is dropped before it is queued
+or formatted once it is over budget, and the next one let through carries how many were suppressed.
+Nothing is written until `setup_logging` is called (benchmarks and worker processes stay silent).
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+# records per second per (logger, event), and the burst allowed on top
+RATE = 1.0
+BURST = 10
+
+logging.getLogger("p2p").addHandler(logging.NullHandler())
+
+
+def get_logger(name):
+    return logging.getLogger(f"p2p.{name}")
+
+
+def fields(**values):
+    """`extra` for a structured record, rendered as key=value (or json keys)"""
+    return {"fields": values}
+
+
+class RateLimitFilter(logging.Filter):
+    """Token bucket per (logger, event), records over budget are counted and dropped"""
+
+    def __init__(self, rate=RATE, burst=BURST):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        # (logger, msg) -> [tokens, last refill, suppressed since the last record let through]
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [self.burst, now, 0]
+            else:
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1
+            suppressed, bucket[2] = bucket[2], 0
+        if suppressed:
+            record.fields = dict(getattr(record, "fields", {}), suppressed=suppressed)
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops a record rather than block when the queue is full"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BackgroundListener(logging.handlers.QueueListener):
+    """QueueListener whose `stop` can be called again (atexit after an explicit stop)"""
+
+    def stop(self):
+        if self._thread is not None:
+            super().stop()
+
+
+class FieldsFormatter(logging.Formatter):
+    """`time level logger event key=value ...`, or one json object per line"""
+
+    def __init__(self, as_json=False):
+        super().__init__("%(asctime)s %(levelname)-7s %(name)s %(message)s", "%H:%M:%S")
+        self.as_json = as_json
+
+    def format(self, record):
+        values = getattr(record, "fields", {})
+        if self.as_json:
+            return json.dumps(dict({
+                "time": record.created,
+                "level": record.levelname,
+                "logger": record.name,
+                "event": record.getMessage()
+            }, **values), default=str)
+        line = super().format(record)
+        for key, value in values.items():
+            text = str(value)
+            line += f" {key}={json.dumps(text) if not text or ' ' in text or '=' in text else text}"
+        return line
+
+
+def setup_logging(level="INFO", path=None, as_json=False, rate=RATE, burst=BURST, max_queue=10000):
+    """Route the p2p loggers through a bounded queue to stdout (or `path`), returns the QueueListener"""
+    log_queue = queue.Queue(max_queue)
+    handler = DroppingQueueHandler(log_queue)
+    handler.addFilter(RateLimitFilter(rate, burst))
+    output = logging.FileHandler(path) if path else logging.StreamHandler(sys.stdout)
+    output.setFormatter(FieldsFormatter(as_json))
+    listener = BackgroundListener(log_queue, output)
+    logger = logging.getLogger("p2p")
+    logger.setLevel(level.upper() if isinstance(level, str) else level)
+    logger.addHandler(handler)
+    # the peer's loggers don't also go to the root logger's handlers
+    logger.propagate = False
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
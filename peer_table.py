@@ -0,0 +1,155 @@
+import random
+import time
+from collections import OrderedDict, deque
+
+
+class PeerTable:
+    """
+    Gossipers we heard from, "host:port" -> {"host", "port", "name", "kick_time", "features"} like the old
+    `received_gossipers` dict, dropped `ttl` seconds after their last GOSSIP / GOSSIP_REPLY.
+        - "features" is what the gossiper advertised in its latest message, it expires with the entry;
+          `with_feature` gives a live view of the gossipers that have one
+        - every entry gets the same ttl, so kick times are queued in the order they were set and the
+          queue front is always the next to expire: refresh is an append, expiry only looks at the
+          expired entries (plus the stale queue slots of entries refreshed since)
+        - `next_batch` walks the table round robin, so a bounded fan-out reaches everyone over a few calls
+        - `sample` picks random gossipers in O(k), keys also live in a list that expiry swap-removes from
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.entries = {}
+        # (kick_time, key) in the order they were set, a slot is stale once its entry was refreshed
+        self.expiry = deque()
+        # live keys in no particular order, key -> its index, for `next_batch` and `sample`
+        self.live = []
+        self.positions = {}
+        self.cursor = 0
+
+    def refresh(self, host, port, name="", now=None, features=frozenset()):
+        """Add or refresh a gossiper, O(1)"""
+        key = f"{host}:{port}"
+        kick_time = (time.time() if now is None else now) + self.ttl
+        self.entries[key] = {
+            "host": host,
+            "port": port,
+            "name": name,
+            "kick_time": kick_time,
+            "features": features
+        }
+        self.expiry.append((kick_time, key))
+        if key not in self.positions:
+            self.positions[key] = len(self.live)
+            self.live.append(key)
+
+    def expire(self, now=None):
+        """Drop gossipers whose `kick_time` has passed, returns how many"""
+        now = time.time() if now is None else now
+        kicked = 0
+        while self.expiry and self.expiry[0][0] < now:
+            kick_time, key = self.expiry.popleft()
+            entry = self.entries.get(key)
+            if entry is not None and entry["kick_time"] == kick_time:
+                del self.entries[key]
+                # swap the last key into its slot
+                index = self.positions.pop(key)
+                last = self.live.pop()
+                if last != key:
+                    self.live[index] = last
+                    self.positions[last] = index
+                kicked += 1
+        return kicked
+
+    def next_batch(self, limit):
+        """Up to `limit` gossipers, continuing where the previous batch stopped"""
+        batch = []
+        for _ in range(min(limit, len(self.live))):
+            if self.cursor >= len(self.live):
+                self.cursor = 0
+            batch.append(self.entries[self.live[self.cursor]])
+            self.cursor += 1
+        return batch
+
+    def sample(self, count, exclude=()):
+        """Up to `count` random gossipers, none of whose "host:port" is in `exclude`"""
+        picked = []
+        for index in random.sample(range(len(self.live)), min(len(self.live), count + len(exclude))):
+            key = self.live[index]
+            if key not in exclude:
+                picked.append(self.entries[key])
+                if len(picked) == count:
+                    break
+        return picked
+
+    def with_feature(self, feature):
+        return FeatureView(self, feature)
+
+    def get(self, key, default=None):
+        return self.entries.get(key, default)
+
+    def items(self):
+        return self.entries.items()
+
+    def values(self):
+        return self.entries.values()
+
+    def __getitem__(self, key):
+        return self.entries[key]
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return repr(self.entries)
+
+
+class FeatureView:
+    """(host, port) membership in the gossipers of a `PeerTable` that advertised `feature`, always current"""
+
+    def __init__(self, table, feature):
+        self.table = table
+        self.feature = feature
+
+    def __contains__(self, host_port):
+        entry = self.table.entries.get(f"{host_port[0]}:{host_port[1]}")
+        return entry is not None and self.feature in entry["features"]
+
+    def __iter__(self):
+        return iter([(entry["host"], entry["port"]) for entry in list(self.table.entries.values())
+                     if self.feature in entry["features"]])
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(set(self))
+
+
+class SeenCache:
+    """LRU set of the last `capacity` keys, `add` tells whether a key is new"""
+
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self.keys = OrderedDict()
+
+    def add(self, key):
+        """Remember `key`, True if it wasn't remembered already"""
+        if key in self.keys:
+            self.keys.move_to_end(key)
+            return False
+        self.keys[key] = None
+        if len(self.keys) > self.capacity:
+            self.keys.popitem(last=False)
+        return True
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __len__(self):
+        return len(self.keys)
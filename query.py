@@ -0,0 +1,65 @@
+"""
+Query the stored chain without disturbing a running peer, one block json per line.
+    python3 query.py block 42
+    python3 query.py hash 8d3c...
+    python3 query.py range 1000 2000
+    python3 query.py miner "some name"
+    python3 query.py time 1700000000 1700086400
+    python3 query.py message "hello" [--prefix]
+Reads go through `ChainQuery`, a read-only connection next to the peer's writer under WAL.
+"""
+import argparse
+import json
+import sys
+
+from blockchain_sql import ChainQuery
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Indexed queries over the stored chain")
+    parser.add_argument("--db", default="blocks.db")
+    parser.add_argument("--limit", type=int, help="stop after this many blocks")
+    parser.add_argument("--page-size", type=int, default=500, help="blocks read per query")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("tip", help="highest stored height")
+    commands.add_parser("block", help="block at a height").add_argument("height", type=int)
+    commands.add_parser("hash", help="blocks with this hash").add_argument("hash")
+    range_parser = commands.add_parser("range", help="blocks with START <= height < END")
+    range_parser.add_argument("start", type=int)
+    range_parser.add_argument("end", type=int)
+    commands.add_parser("miner", help="blocks mined by NAME").add_argument("name")
+    time_parser = commands.add_parser("time", help="blocks with START <= timestamp < END")
+    time_parser.add_argument("start", type=int)
+    time_parser.add_argument("end", type=int)
+    message_parser = commands.add_parser("message", help="blocks holding this message")
+    message_parser.add_argument("text")
+    message_parser.add_argument("--prefix", action="store_true", help="messages starting with TEXT")
+    args = parser.parse_args()
+
+    query = ChainQuery(args.db)
+    if args.command == "tip":
+        print(query.tip())
+        return
+    if args.command == "block":
+        block = query.block(args.height)
+        blocks = [block] if block else []
+    elif args.command == "hash":
+        blocks = query.by_hash(args.hash)
+    elif args.command == "range":
+        blocks = query.stream(query.range, args.start, args.end, page_size=args.page_size)
+    elif args.command == "miner":
+        blocks = query.stream(query.mined_by, args.name, page_size=args.page_size)
+    elif args.command == "time":
+        blocks = query.stream(query.time_range, args.start, args.end, page_size=args.page_size)
+    else:
+        blocks = query.stream(lambda text, after, limit: query.with_message(text, args.prefix, after, limit),
+                              args.text, page_size=args.page_size)
+    for count, block in enumerate(blocks, 1):
+        sys.stdout.write(json.dumps(block) + "\n")
+        if args.limit is not None and count >= args.limit:
+            break
+    query.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+class ReplyCache:
+    """
+    Encoded reply datagrams, so serving the same verified block or STATS_REPLY again is a dict lookup.
+        - GET_BLOCK_REPLY bytes per (height, binary), stored with the block they were encoded from and
+          only served while that same block is still the one in verified_blocks, a block replaced by a
+          resync can never be answered from a stale entry
+        - STATS_REPLY bytes per binary, encoded once per consensus_key
+    `hits` / `misses` count block replies, `stats_encodes` counts how often the stats reply was rebuilt.
+    """
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        # (height, binary) -> (block, bytes)
+        self.blocks = {}
+        self.stats_key = None
+        # binary -> bytes for `stats_key`
+        self.stats = {}
+        self.hits = 0
+        self.misses = 0
+        self.stats_encodes = 0
+
+    def block_reply(self, block, binary, encode):
+        """Bytes for `block`, `encode(block)` is only called on a miss"""
+        key = (block["height"], binary)
+        entry = self.blocks.get(key)
+        if entry is not None and entry[0] is block:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        data = encode(block)
+        # bounded, same as BlockStore's caches, dropping it only costs re-encoding
+        if len(self.blocks) >= self.max_entries:
+            self.blocks.clear()
+        self.blocks[key] = (block, data)
+        return data
+
+    def stats_reply(self, consensus_key, binary, encode):
+        """Bytes of the STATS_REPLY for `consensus_key`, `encode()` is only called when it changed"""
+        if consensus_key != self.stats_key:
+            self.stats_key = consensus_key
+            self.stats = {}
+        data = self.stats.get(binary)
+        if data is None:
+            data = self.stats[binary] = encode()
+            self.stats_encodes += 1
+        return data
+
+    def truncate(self, height):
+        """Forget block replies at `height` and above"""
+        for key in [key for key in self.blocks if key[0] >= height]:
+            del self.blocks[key]
+
+    def clear(self):
+        self.blocks.clear()
+        self.stats_key = None
+        self.stats = {}
+
+    def counters(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "cached_replies": len(self.blocks),
+            "stats_encodes": self.stats_encodes
+        }
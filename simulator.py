@@ -0,0 +1,221 @@
+"""
+Runs a whole network in one process on loopback, no umanitoba hosts needed.
+Seed peers start with a synthetic chain mined at a low difficulty, every other peer starts empty
+and has to find the seeds through gossip, agree on their chain and download + verify it.
+Every datagram goes through a `LossyLink` that drops, delays and reorders it.
+    python3 simulator.py [--peers N] [--seeds S] [--blocks B] [--loss 0.05] [--delay 0.01] ...
+Reports time to full sync, datagrams and bytes sent per peer.
+"""
+import argparse
+import contextlib
+import io
+import json
+import random
+import statistics
+import threading
+import time
+import uuid
+
+from event_queue import EventQueue
+from main import periodic_jobs
+from miner import block_prefix, search
+from peer import Peer
+from peer_log import setup_logging
+
+
+def synthetic_chain(length, difficulty, seed=0):
+    """`length` blocks in the GET_BLOCK_REPLY format `verification` checks, each linked to the one before"""
+    rng = random.Random(seed)
+    blocks = []
+    prev_hash = ""
+    for height in range(length):
+        messages = [f"sim block {height}"] + [f"msg {rng.randrange(10 ** 6)}" for _ in range(rng.randrange(3))]
+        timestamp = 1700000000 + height * 60
+        prefix = block_prefix(prev_hash, "simulator", messages, timestamp)
+        start = 0
+        while True:
+            nonce, block_hash, _ = search(prefix, start, start + 100000, difficulty)
+            if nonce is not None:
+                break
+            start += 100000
+        blocks.append({
+            "type": "GET_BLOCK_REPLY",
+            "hash": block_hash,
+            "height": height,
+            "messages": messages,
+            "minedBy": "simulator",
+            "nonce": nonce,
+            "timestamp": timestamp
+        })
+        prev_hash = block_hash
+    return blocks
+
+
+class LossyLink:
+    """
+    Stands in for the network: replaces `Peer.send_to` of every attached peer.
+    A datagram is dropped with probability `loss`, otherwise sent from the peer's own socket after
+    `delay` + up to `jitter` seconds, and with probability `reorder` held back another `delay` + `jitter`
+    so it lands behind datagrams sent after it. Counts what every peer sent.
+    """
+
+    def __init__(self, loss=0.0, delay=0.0, jitter=0.0, reorder=0.0, seed=None):
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.reorder = reorder
+        self.random = random.Random(seed)
+        self.queue = EventQueue()
+        self.lock = threading.Lock()
+        # (host, port) -> [datagrams, bytes, dropped]
+        self.sent = {}
+        threading.Thread(target=self.queue.run, daemon=True).start()
+
+    def attach(self, peer):
+        counters = self.sent[(peer.host, peer.port)] = [0, 0, 0]
+
+        def send_to(data, host, port):
+            with self.lock:
+                counters[0] += 1
+                counters[1] += len(data)
+                if self.random.random() < self.loss:
+                    counters[2] += 1
+                    return
+                delay = self.delay + self.random.random() * self.jitter
+                if self.random.random() < self.reorder:
+                    delay += self.delay + self.jitter
+            if delay > 0:
+                self.queue.add_event(time.time() + delay, deliver, [data, host, port])
+            else:
+                deliver(data, host, port)
+
+        def deliver(data, host, port):
+            try:
+                peer.socket.sendto(data, (host, port))
+            except OSError:
+                pass
+
+        peer.send_to = send_to
+
+    def stop(self):
+        self.queue.stop()
+
+
+def loopback_host(index):
+    """
+    Every peer gets its own loopback address, admission control budgets per host so peers sharing
+    127.0.0.1 would share their budgets too. Linux routes all of 127.0.0.0/8 to loopback.
+    """
+    return f"127.0.{index // 250}.{index % 250 + 1}"
+
+
+def scaled_jobs(peer, time_scale):
+    """The jobs of `main.periodic_jobs` with every delay / interval multiplied by `time_scale`"""
+    return [(delay * time_scale, interval * time_scale, callback, args)
+            for delay, interval, callback, args in periodic_jobs(peer)]
+
+
+def run(peers=8, seeds=1, blocks=200, difficulty=3, loss=0.0, delay=0.0, jitter=0.0, reorder=0.0,
+        fanout=3, time_scale=0.1, timeout=120.0, base_port=21000, seed=None, quiet=True):
+    """Simulate one network until every peer holds the full chain or `timeout`, returns the metrics dict"""
+    chain = synthetic_chain(blocks, difficulty)
+    link = LossyLink(loss, delay, jitter, reorder, seed)
+    jobs = EventQueue()
+    seed_addresses = [(loopback_host(index), base_port + index) for index in range(seeds)]
+    output = io.StringIO() if quiet else None
+    with contextlib.redirect_stdout(output) if quiet else contextlib.nullcontext():
+        network = []
+        for index in range(peers):
+            peer = Peer(base_port + index, f"sim-{index}", str(uuid.uuid4()),
+                        bootstrap_peers=seed_addresses, host=loopback_host(index))
+            peer.difficulty = difficulty
+            peer.gossip_fanout = fanout
+            link.attach(peer)
+            if index < seeds:
+                peer.verified_blocks.update({block["height"]: block for block in chain})
+                peer.verified_tip = blocks
+                peer.consensus_key = (blocks, chain[-1]["hash"])
+                peer.verified_chain_flag = True
+            network.append(peer)
+
+        start = time.time()
+        for peer in network:
+            threading.Thread(target=peer.listen, daemon=True).start()
+            for job_delay, interval, callback, args in scaled_jobs(peer, time_scale):
+                jobs.add_event(start + job_delay, callback, args, interval)
+        threading.Thread(target=jobs.run, daemon=True).start()
+
+        synced_at = {}
+        while len(synced_at) < peers and time.time() - start < timeout:
+            for peer in network:
+                if peer.port not in synced_at and peer.verified_chain_flag and peer.verified_tip >= blocks:
+                    synced_at[peer.port] = time.time() - start
+            time.sleep(0.02)
+        jobs.stop()
+        link.stop()
+
+    per_peer = []
+    for peer in network:
+        datagrams, sent_bytes, dropped = link.sent[(peer.host, peer.port)]
+        per_peer.append({
+            "port": peer.port,
+            "seed": peer.port - base_port < seeds,
+            "sync_seconds": synced_at.get(peer.port),
+            "datagrams_sent": datagrams,
+            "bytes_sent": sent_bytes,
+            "dropped": dropped,
+            "known_peers": len(peer.received_gossipers)
+        })
+    sync_times = [entry["sync_seconds"] for entry in per_peer if not entry["seed"] and entry["sync_seconds"] is not None]
+    return {
+        "config": {"peers": peers, "seeds": seeds, "blocks": blocks, "difficulty": difficulty, "loss": loss,
+                   "delay": delay, "jitter": jitter, "reorder": reorder, "fanout": fanout, "time_scale": time_scale},
+        "synced": len(synced_at),
+        "time_to_full_sync": max(sync_times) if len(synced_at) == peers else None,
+        "median_sync_seconds": statistics.median(sync_times) if sync_times else None,
+        "datagrams_per_peer": statistics.mean(entry["datagrams_sent"] for entry in per_peer),
+        "bytes_per_peer": statistics.mean(entry["bytes_sent"] for entry in per_peer),
+        "peers": per_peer
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate a local network and measure how fast it syncs")
+    parser.add_argument("--peers", type=int, default=8)
+    parser.add_argument("--seeds", type=int, default=1, help="peers that start with the full chain")
+    parser.add_argument("--blocks", type=int, default=200, help="length of the synthetic chain")
+    parser.add_argument("--difficulty", type=int, default=3, help="trailing hex zeros of the synthetic chain")
+    parser.add_argument("--loss", type=float, default=0.0, help="probability a datagram is dropped")
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds every datagram is delayed")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random delay, up to this many seconds")
+    parser.add_argument("--reorder", type=float, default=0.0, help="probability a datagram is held back behind later ones")
+    parser.add_argument("--fanout", type=int, default=3)
+    parser.add_argument("--time-scale", type=float, default=0.1, help="multiplies every periodic job delay / interval")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--base-port", type=int, default=21000)
+    parser.add_argument("--seed", type=int, help="random seed of the lossy link")
+    parser.add_argument("--verbose", action="store_true", help="show the peers' own output")
+    parser.add_argument("--json", help="also write the full metrics to this file")
+    args = parser.parse_args()
+    if args.verbose:
+        setup_logging("INFO")
+
+    result = run(args.peers, args.seeds, args.blocks, args.difficulty, args.loss, args.delay, args.jitter,
+                 args.reorder, args.fanout, args.time_scale, args.timeout, args.base_port, args.seed,
+                 quiet=not args.verbose)
+    print(f"{'port':>6}{'seed':>6}{'sync s':>9}{'datagrams':>11}{'bytes':>11}{'dropped':>9}{'peers':>7}")
+    for entry in result["peers"]:
+        sync = "-" if entry["sync_seconds"] is None else f"{entry['sync_seconds']:.2f}"
+        print(f"{entry['port']:>6}{'yes' if entry['seed'] else '':>6}{sync:>9}{entry['datagrams_sent']:>11}"
+              f"{entry['bytes_sent']:>11}{entry['dropped']:>9}{entry['known_peers']:>7}")
+    full = result["time_to_full_sync"]
+    print(f"{result['synced']}/{args.peers} synced, time to full sync "
+          f"{'-' if full is None else f'{full:.2f}s'}, {result['datagrams_per_peer']:.0f} datagrams / "
+          f"{result['bytes_per_peer']:.0f} bytes sent per peer")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
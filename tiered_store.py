@@ -0,0 +1,149 @@
+import json
+import mmap
+import struct
+import tempfile
+
+import wire_codec
+
+# index record per height: end offsets of its JSON and its binary reply in the segment, hash in ascii
+INDEX = struct.Struct("<QQ64s")
+
+
+class TieredChain:
+    """
+    The verified chain as height -> GET_BLOCK_REPLY json, replaces the `verified_blocks` dict.
+        - the newest `hot_size` blocks stay dicts in memory, the tip is where blocks are added, replaced and announced
+        - older ones are spilled in batches to an append-only segment of their encoded replies plus a fixed-width
+          index (`INDEX` per height), both read through `mmap`, so memory stays flat as the chain grows
+        - every cold block is stored as its JSON reply followed by its binary one (empty when the block doesn't fit
+          the binary format), both encoded once at spill time
+        - `raw` hands out a cold block's reply as a memoryview into the map, served without a copy or a re-encode
+    The segment is scratch for this process (the sqlite db is what survives a restart). `truncate` only moves the
+    end back and the files never shrink, so a reader still holding an old map can never fault on a cut page
+    (at worst a reply racing a resync is served stale, which the receiver's verification rejects).
+    Writers are serialized by the peer's verify lock; readers take no lock, a cold read sees one consistent
+    (map, index, count) snapshot.
+    """
+
+    def __init__(self, hot_size=2048, spill_batch=256):
+        self.hot_size = hot_size
+        self.spill_batch = spill_batch
+        # height -> block json for heights >= the cold count
+        self.hot = {}
+        self.data_file = tempfile.TemporaryFile()
+        self.index_file = tempfile.TemporaryFile()
+        # (data map, index map, cold count), replaced as a whole on every spill / truncate
+        self.segment = (None, None, 0)
+
+    # cold tier ------------------------------------------------------------------------------------------------------
+    def spill(self):
+        """Move the oldest hot blocks to the segment until `hot_size` are left"""
+        data_map, index_map, count = self.segment
+        start = end = INDEX.unpack_from(index_map, (count - 1) * INDEX.size)[1] if count else 0
+        chunks = []
+        records = []
+        while len(self.hot) - len(records) > self.hot_size and count + len(records) in self.hot:
+            block = self.hot[count + len(records)]
+            data = encode_reply(block)
+            binary = wire_codec.encode(block) or b""
+            json_end = end + len(data)
+            end = json_end + len(binary)
+            chunks.append(data)
+            chunks.append(binary)
+            records.append(INDEX.pack(json_end, end, block["hash"].encode("ascii")))
+        if not records:
+            return
+        self.data_file.seek(start)
+        self.data_file.write(b"".join(chunks))
+        self.data_file.flush()
+        self.index_file.seek(count * INDEX.size)
+        self.index_file.write(b"".join(records))
+        self.index_file.flush()
+        # readers keep the old maps alive through their views, they are unmapped once the last one is gone
+        self.segment = (mmap.mmap(self.data_file.fileno(), 0, access=mmap.ACCESS_READ),
+                        mmap.mmap(self.index_file.fileno(), 0, access=mmap.ACCESS_READ),
+                        count + len(records))
+        for height in range(count, count + len(records)):
+            del self.hot[height]
+
+    def raw(self, height, binary=False):
+        """
+        GET_BLOCK_REPLY of a cold block as a memoryview into the segment, None if it isn't cold.
+        With `binary` the binary reply, or the JSON one for a block that has none, as `Peer.encode` would send.
+        """
+        data_map, index_map, count = self.segment
+        if not 0 <= height < count:
+            return None
+        start = INDEX.unpack_from(index_map, (height - 1) * INDEX.size)[1] if height else 0
+        json_end, end = INDEX.unpack_from(index_map, height * INDEX.size)[:2]
+        if binary and end > json_end:
+            return memoryview(data_map)[json_end:end]
+        return memoryview(data_map)[start:json_end]
+
+    def cold_count(self):
+        return self.segment[2]
+
+    # chain ------------------------------------------------------------------------------------------------------------
+    def hash_at(self, height):
+        """Hash of the block at `height`, a cold one is read from the index without decoding the block"""
+        block = self.hot.get(height)
+        if block is not None:
+            return block["hash"]
+        data_map, index_map, count = self.segment
+        if not 0 <= height < count:
+            raise KeyError(height)
+        return INDEX.unpack_from(index_map, height * INDEX.size)[2].rstrip(b"\0").decode("ascii")
+
+    def truncate(self, height):
+        """Drop heights at `height` and above"""
+        for dropped in [key for key in self.hot if key >= height]:
+            del self.hot[dropped]
+        data_map, index_map, count = self.segment
+        if height < count:
+            self.segment = (data_map, index_map, max(0, height))
+
+    def __setitem__(self, height, block):
+        if height < self.segment[2]:
+            # replacing a cold block means the chain below changed, everything from it on is rewritten
+            self.truncate(height)
+        self.hot[height] = block
+        if len(self.hot) >= self.hot_size + self.spill_batch:
+            self.spill()
+
+    def __getitem__(self, height):
+        block = self.hot.get(height)
+        if block is not None:
+            return block
+        view = self.raw(height)
+        if view is None:
+            raise KeyError(height)
+        return json.loads(bytes(view))
+
+    def get(self, height, default=None):
+        try:
+            return self[height]
+        except KeyError:
+            return default
+
+    def update(self, blocks):
+        for height in sorted(blocks):
+            self[height] = blocks[height]
+
+    def __contains__(self, height):
+        return height in self.hot or 0 <= height < self.segment[2]
+
+    def __len__(self):
+        return len(self.hot) + self.segment[2]
+
+    def __repr__(self):
+        return f"<TieredChain {self.segment[2]} cold, hot {self.hot}>"
+
+    def close(self):
+        self.segment = (None, None, 0)
+        self.data_file.close()
+        self.index_file.close()
+
+
+def encode_reply(block):
+    """JSON GET_BLOCK_REPLY bytes, the same `Peer.encode` sends to a JSON peer"""
+    return json.dumps(block).encode('utf-8')
@@ -0,0 +1,215 @@
+"""
+Compact binary encoding for the block-sync messages, only sent to peers that advertised it in
+GOSSIP / GOSSIP_REPLY ("codecs": ["bin2"]). Everyone else keeps getting JSON.
+
+    header      magic 0xB1 (never the first byte of JSON) | type code      2 bytes
+    hash        raw 32 bytes when it is 64 lowercase hex chars, else a length-prefixed string (flags bit 0)
+    strings     u16 length + utf-8 bytes
+    string list u8 count | u16 byte size | the utf-8 strings joined by NUL, one decode + split on the way in
+                (a block with a NUL in any string is sent as JSON)
+    numbers     big-endian, height u32, timestamp u64, port u16
+
+    GET_BLOCK           header | height
+    GET_BLOCK_REPLY     header | flags | height | timestamp | hash | string list [minedBy, nonce, messages...]
+                        with a raw hash everything before the strings is read in one unpack
+    ANNOUNCE            same as GET_BLOCK_REPLY
+    STATS               header
+    STATS_REPLY         header | flags | height | hash | host | port
+    GET_BLOCKS          header | height | u16 count
+    GET_BLOCKS_REPLY    header | u8 block count | per block: u16 length | GET_BLOCK_REPLY without its header
+"""
+import struct
+
+# bin1 sent u16 lengths per string, bin2 peers don't advertise it so the two fall back to JSON between them
+CODEC_NAME = "bin2"
+MAGIC = 0xB1
+
+TYPE_CODES = {
+    "GET_BLOCK": 1,
+    "GET_BLOCK_REPLY": 2,
+    "ANNOUNCE": 3,
+    "STATS": 4,
+    "STATS_REPLY": 5,
+    "GET_BLOCKS": 6,
+    "GET_BLOCKS_REPLY": 7,
+}
+CODE_TYPES = {code: msg_type for msg_type, code in TYPE_CODES.items()}
+
+HEADER = struct.Struct(">BB")
+U8 = struct.Struct(">B")
+U16 = struct.Struct(">H")
+U32 = struct.Struct(">I")
+BLOCK_FIXED = struct.Struct(">BIQ")  # flags, height, timestamp
+# the same followed by a raw hash and the string list's count and size, what nearly every block is
+BLOCK_RAW = struct.Struct(">BIQ32sBH")
+STRS = struct.Struct(">BH")  # string list count, byte size
+SEPARATOR = "\0"
+STATS_FIXED = struct.Struct(">BI")  # flags, height
+RANGE_FIXED = struct.Struct(">IH")  # height, count
+RAW_HASH = 0x01
+
+
+def is_binary(data):
+    return len(data) > 0 and data[0] == MAGIC
+
+
+def encode(msg):
+    """Binary bytes for `msg`, None if its type or values don't fit the format (send JSON instead)"""
+    code = TYPE_CODES.get(msg.get("type"))
+    if code is None:
+        return None
+    try:
+        out = [HEADER.pack(MAGIC, code)]
+        if code == 1:
+            out.append(U32.pack(msg["height"]))
+        elif code in (2, 3):
+            body = encode_block_body(msg)
+            if body is None:
+                return None
+            out.append(body)
+        elif code == 5:
+            flags, hash_bytes = pack_hash(msg["hash"])
+            out.append(STATS_FIXED.pack(flags, int(msg["height"])))
+            out.append(hash_bytes)
+            out.append(pack_str(msg["host"]))
+            out.append(U16.pack(msg["port"]))
+        elif code == 6:
+            out.append(RANGE_FIXED.pack(msg["height"], msg["count"]))
+        elif code == 7:
+            bodies = [encode_block_body(block) for block in msg["blocks"]]
+            if None in bodies:
+                return None
+            return pack_blocks_reply(bodies)
+        return b"".join(out)
+    except (KeyError, TypeError, ValueError, AttributeError, struct.error):
+        return None
+
+
+def decode(data):
+    """Binary bytes back to the same dict the JSON protocol carries, ValueError if malformed"""
+    if not isinstance(data, bytes):
+        data = bytes(data)
+    try:
+        magic, code = HEADER.unpack_from(data, 0)
+        msg_type = CODE_TYPES.get(code)
+        if magic != MAGIC or msg_type is None:
+            raise ValueError(f"unknown binary message {magic}:{code}")
+        offset = HEADER.size
+        if code in (2, 3):
+            return decode_block_body(data, offset, len(data), msg_type)[0]
+        msg = {"type": msg_type}
+        if code == 1:
+            msg["height"], = U32.unpack_from(data, offset)
+        elif code == 5:
+            flags, msg["height"] = STATS_FIXED.unpack_from(data, offset)
+            offset += STATS_FIXED.size
+            msg["hash"], offset = unpack_hash(data, offset, flags)
+            msg["host"], offset = unpack_str(data, offset)
+            msg["port"], = U16.unpack_from(data, offset)
+        elif code == 6:
+            msg["height"], msg["count"] = RANGE_FIXED.unpack_from(data, offset)
+        elif code == 7:
+            count, = U8.unpack_from(data, offset)
+            offset += U8.size
+            blocks = []
+            for _ in range(count):
+                length, = U16.unpack_from(data, offset)
+                offset += U16.size
+                end = offset + length
+                if len(data) < end:
+                    raise ValueError("truncated block")
+                blocks.append(decode_block_body(data, offset, end)[0])
+                offset = end
+            msg["blocks"] = blocks
+        return msg
+    except (struct.error, UnicodeDecodeError, IndexError, TypeError) as e:
+        raise ValueError(f"malformed binary message: {e}")
+
+
+def encode_block_body(block):
+    """GET_BLOCK_REPLY / ANNOUNCE fields after the header, None if they don't fit the format"""
+    try:
+        block_hash = block["hash"]
+        strings = [block["minedBy"], block["nonce"], *block["messages"]]
+        text = SEPARATOR.join(strings)
+        if text.count(SEPARATOR) != len(strings) - 1:
+            return None
+        raw = text.encode("utf-8")
+        if len(block_hash) == 64:
+            hash_bytes = bytes.fromhex(block_hash)
+            # only lowercase hex survives the round trip unchanged
+            if len(hash_bytes) == 32 and hash_bytes.hex() == block_hash:
+                return BLOCK_RAW.pack(RAW_HASH, block["height"], block["timestamp"], hash_bytes,
+                                      len(strings), len(raw)) + raw
+        return b"".join([BLOCK_FIXED.pack(0, block["height"], block["timestamp"]), pack_str(block_hash),
+                         STRS.pack(len(strings), len(raw)), raw])
+    except (KeyError, TypeError, ValueError, AttributeError, struct.error):
+        return None
+
+
+def decode_block_body(data, offset, end, msg_type="GET_BLOCK_REPLY"):
+    """(block dict, offset after it) for a body at `offset` that must end by `end`, `data` is bytes"""
+    if data[offset] & RAW_HASH:
+        _, height, timestamp, raw_hash, count, size = BLOCK_RAW.unpack_from(data, offset)
+        block_hash = raw_hash.hex()
+        offset += BLOCK_RAW.size
+    else:
+        _, height, timestamp = BLOCK_FIXED.unpack_from(data, offset)
+        block_hash, offset = unpack_str(data, offset + BLOCK_FIXED.size)
+        count, size = STRS.unpack_from(data, offset)
+        offset += STRS.size
+    stop = offset + size
+    if stop > end:
+        raise ValueError("truncated string list")
+    strings = data[offset:stop].decode("utf-8").split(SEPARATOR)
+    if len(strings) != count or count < 2:
+        raise ValueError("bad string list")
+    return {"type": msg_type, "hash": block_hash, "height": height, "messages": strings[2:],
+            "minedBy": strings[0], "nonce": strings[1], "timestamp": timestamp}, stop
+
+
+def pack_blocks_reply(bodies):
+    """GET_BLOCKS_REPLY datagram from bodies made by `encode_block_body`, at most 255 of them"""
+    out = [HEADER.pack(MAGIC, TYPE_CODES["GET_BLOCKS_REPLY"]), U8.pack(len(bodies))]
+    for body in bodies:
+        out.append(U16.pack(len(body)))
+        out.append(body)
+    return b"".join(out)
+
+
+def blocks_reply_size(body_sizes):
+    """Datagram size `pack_blocks_reply` makes for bodies of these sizes"""
+    return HEADER.size + U8.size + sum(U16.size + size for size in body_sizes)
+
+
+def pack_hash(block_hash):
+    if len(block_hash) == 64:
+        try:
+            raw = bytes.fromhex(block_hash)
+            # only lowercase hex survives the round trip unchanged
+            if raw.hex() == block_hash:
+                return RAW_HASH, raw
+        except ValueError:
+            pass
+    return 0, pack_str(block_hash)
+
+
+def unpack_hash(data, offset, flags):
+    if flags & RAW_HASH:
+        if len(data) < offset + 32:
+            raise ValueError("truncated hash")
+        return data[offset:offset + 32].hex(), offset + 32
+    return unpack_str(data, offset)
+
+
+def pack_str(value):
+    raw = value.encode("utf-8")
+    return U16.pack(len(raw)) + raw
+
+
+def unpack_str(data, offset):
+    length, = U16.unpack_from(data, offset)
+    offset += U16.size
+    if len(data) < offset + length:
+        raise ValueError("truncated string")
+    return data[offset:offset + length].decode("utf-8"), offset + length